@@ -0,0 +1,177 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Cold start benchmark of the three lambda handlers. Each run is a fresh
+# python process that times the handler's import, its first invocation and a
+# second (warm) one. Nothing leaves the machine, every AWS request is answered
+# with an empty canned response at botocore's before-send hook, so the numbers
+# are the python side of a cold start: imports, client and model loading.
+#   python Back-End/benchmarks/cold_start_benchmark.py
+#   python Back-End/benchmarks/cold_start_benchmark.py --runs 10 --json cold.json
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+here = os.path.abspath(__file__)
+lambdas = os.path.join(os.path.dirname(here), '..', 'lambdas')
+
+environment = {
+    'ENV_ACCOUNTS': '111111111111',
+    'ENV_SOURCE_ACCOUNT': '111111111111',
+    'ENV_SOURCE_REGION': 'us-east-1',
+    'ENV_REGIONS': 'us-east-1',
+    'ENV_CROSS_ACCOUNT_ROLE': 'CrossAccountAccess',
+    'ENV_TABLE_NAME_MULTI': 'benchmark',
+    'ENV_SQSQUEUE': 'https://sqs.us-east-1.amazonaws.com/111111111111/benchmark',
+    'ENV_LOG_LEVEL': 'WARNING',
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    'AWS_DEFAULT_REGION': 'us-east-1'
+}
+
+# A typical first event for every handler
+events = {
+    'send_sqs_message': {'queryStringParameters': {'function': 'cron'}},
+    'receive_sqs_message': {'Records': [{
+        'messageId': 'benchmark',
+        'messageAttributes': {
+            'Function': {'stringValue': 'lambda'},
+            'AccountNumber': {'stringValue': '111111111111'},
+            'Region': {'stringValue': 'us-east-1'}
+        }
+    }]},
+    'list_table': {'queryStringParameters': {'scan': 'lambda'}, 'headers': {'Accept-Encoding': 'gzip'}}
+}
+
+
+# Empty response for any operation. Json protocols get every list in the
+# output shape as [], xml ones an empty <Operation>Response.
+class CannedResponse(object):
+
+    def __init__(self, service_model, operation, request):
+        output_shape = service_model.operation_model(operation).output_shape
+
+        self.status_code = 200
+        self.url = request.url
+        if service_model.protocol in ('json', 'rest-json'):
+            members = output_shape.members.items() if output_shape is not None else []
+            body = {shape.serialization.get('name', name): [] for name, shape in members if shape.type_name == 'list'}
+            self.headers = {'Content-Type': 'application/x-amz-json-1.0'}
+            self.content = json.dumps(body).encode('utf-8')
+        else:
+            self.headers = {'Content-Type': 'text/xml'}
+            self.content = f'<{operation}Response><{operation}Result/></{operation}Response>'.encode('utf-8')
+        self.text = self.content.decode('utf-8')
+        self.raw = self
+
+    def stream(self, **kwargs):
+        yield self.content
+
+
+# Answer every request of every client (boto3.client, boto3.resource and the
+# receiver's own sessions) locally
+def install_canned_responses():
+
+    import botocore.session
+
+    create_client = botocore.session.Session.create_client
+
+    def create_canned_client(self, *args, **kwargs):
+        client = create_client(self, *args, **kwargs)
+        service_model = client.meta.service_model
+
+        def canned_response(request, event_name, **kwargs):
+            return CannedResponse(service_model, event_name.split('.')[-1], request)
+
+        client.meta.events.register('before-send', canned_response)
+        return client
+
+    botocore.session.Session.create_client = create_canned_client
+
+
+# One cold start in this process, printed as json for the parent
+def child(handler):
+
+    os.environ.update(environment)
+    sys.path.insert(0, lambdas)
+
+    start = time.perf_counter()
+    install_canned_responses()
+    setup_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    module = __import__(handler)
+    import_ms = (time.perf_counter() - start) * 1000
+
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            start = time.perf_counter()
+            module.lambda_handler(events[handler], None)
+            first_ms = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            module.lambda_handler(events[handler], None)
+            warm_ms = (time.perf_counter() - start) * 1000
+        finally:
+            sys.stdout = stdout
+
+    print(json.dumps({
+        'setup_ms': setup_ms,
+        'import_ms': import_ms,
+        'first_ms': first_ms,
+        'warm_ms': warm_ms,
+        'modules': len(sys.modules)
+    }))
+
+
+def run(handler, runs):
+
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, here, '--child', handler],
+                                check=True, stdout=subprocess.PIPE).stdout
+        samples.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+
+    result = {'handler': handler, 'runs': runs, 'modules': samples[-1]['modules']}
+    for key in ('import_ms', 'first_ms', 'warm_ms'):
+        values = [s[key] for s in samples]
+        result[key] = round(statistics.median(values), 2)
+        result[key.replace('_ms', '_min_ms')] = round(min(values), 2)
+    result['cold_ms'] = round(result['import_ms'] + result['first_ms'], 2)
+
+    return result
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Import and first invocation time of the lambda handlers')
+    parser.add_argument('--runs', type=int, default=5, help='fresh processes per handler, the median is reported')
+    parser.add_argument('--handlers', default=','.join(events), help='handlers to measure, comma separated')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args.child)
+
+    results = [run(h, args.runs) for h in args.handlers.split(',')]
+
+    print(f"{'handler':<22}{'import ms':>11}{'first ms':>10}{'cold ms':>10}{'warm ms':>10}{'modules':>9}")
+    for r in results:
+        print(f"{r['handler']:<22}{r['import_ms']:>11.1f}{r['first_ms']:>10.1f}{r['cold_ms']:>10.1f}"
+              f"{r['warm_ms']:>10.1f}{r['modules']:>9}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'\nwrote {args.json}')
+
+
+if __name__ == '__main__':
+    main()
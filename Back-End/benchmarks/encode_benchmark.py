@@ -0,0 +1,112 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Micro-benchmark of the list_table response encoding. The previous path let
+# the resource layer deserialise query pages into Decimals and encoded them with
+# json.dumps(..., cls=DecimalEncoder), list_table now converts the low level
+# AttributeValues with plain_item and encodes with encode_json. Also reports the
+# size and cost of compressing the body.
+#   python Back-End/benchmarks/encode_benchmark.py [items]
+
+import os
+import sys
+import gzip
+import json
+import time
+import decimal
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdas'))
+
+import list_table  # noqa: E402
+
+
+# The encoder reply() used before, truncates fractions
+class DecimalEncoder(json.JSONEncoder):
+
+    def default(self, obj):  # pylint: disable=E0202
+        if isinstance(obj, decimal.Decimal):
+            return int(obj)
+        return super(DecimalEncoder, self).default(obj)
+
+
+def old_encode(raw_items):
+
+    deserializer = TypeDeserializer()
+    items = [{k: deserializer.deserialize(v) for k, v in i.items()} for i in raw_items]
+
+    return json.dumps(items, cls=DecimalEncoder)
+
+
+def new_encode(raw_items):
+    return list_table.encode_json([list_table.plain_item(i) for i in raw_items])
+
+
+# ec2 shaped items as the low level client hands them back from dynamo
+def make_items(count):
+
+    serializer = TypeSerializer()
+
+    items = []
+    for i in range(count):
+        items.append({
+            'Id': f'0f6c2b9e-{i:04x}-5d3a-9b1e-3c2a7f0d{i:04x}',
+            'EntryType': 'ec2',
+            'InstanceId': f'i-0{i:016x}',
+            'State': 'running' if i % 7 else 'stopped',
+            'AccountNumber': f'{111111111111 + i % 40}',
+            'Region': ['ap-southeast-2', 'us-east-1', 'eu-west-1'][i % 3],
+            'vCPU': decimal.Decimal(2 ** (i % 4)),
+            'HourlyCost': decimal.Decimal('0.0416') * (i % 5 + 1),
+            'KeyName': f'key-{i % 12}',
+            'RoleName': f'role-{i % 30}',
+            'PrivateIpAddress': f'10.0.{i // 256 % 256}.{i % 256}',
+            'InstancePlatform': 'Linux/UNIX',
+            'InstanceType': ['t3.micro', 'm5.large', 'c5.xlarge'][i % 3],
+            'ContentHash': f'{i:040x}'
+        })
+
+    return [{k: serializer.serialize(v) for k, v in i.items()} for i in items]
+
+
+# Best of a few runs, seconds
+def best_of(fn, arg, runs=5):
+
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn(arg)
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def main():
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    items = make_items(count)
+
+    old_body = old_encode(items)
+    new_body = new_encode(items)
+
+    old_seconds = best_of(old_encode, items)
+    new_seconds = best_of(new_encode, items)
+
+    print(f'{count} items')
+    print(f'DecimalEncoder : {old_seconds * 1000:8.1f} ms  {len(old_body):>10} bytes (fractions truncated)')
+    print(f'plain_item     : {new_seconds * 1000:8.1f} ms  {len(new_body):>10} bytes  x{old_seconds / new_seconds:.2f}')
+
+    raw = new_body.encode('utf-8')
+    for encoding in ['gzip', 'br']:
+        if encoding == 'br' and list_table.brotli is None:
+            print('br             : brotli not installed')
+            continue
+        seconds = best_of(lambda body: list_table.compress_body(body, encoding), raw, runs=3)
+        size = len(list_table.compress_body(raw, encoding))
+        print(f'{encoding:<15}: {seconds * 1000:8.1f} ms  {size:>10} bytes  ({size / len(raw):.1%} of raw)')
+
+    assert json.loads(gzip.decompress(list_table.compress_body(raw, 'gzip'))) == json.loads(new_body)
+
+
+if __name__ == '__main__':
+    main()
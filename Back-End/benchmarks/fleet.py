@@ -0,0 +1,497 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Synthetic org inventory and local stand-ins for the AWS apis the lambdas
+# call, so the real handlers can run end to end without an account.
+# Used by fleet_benchmark.py.
+
+import re
+import json
+import random
+import threading
+from collections import Counter, defaultdict
+from botocore.exceptions import ClientError
+
+
+# Global services only show up in us-east-1
+global_types = ['iam-roles', 'iam-users', 'iam-attached-policys', 's3-buckets', 'org']
+
+
+# (service, operation) to the result key of its listing, the entry type it
+# feeds and the page size the paginator hands back, None for the calls that
+# have no paginator and return everything at once
+listings = {
+    ('ec2', 'describe_instances'): ('Reservations', 'ec2', 1000),
+    ('ec2', 'describe_vpcs'): ('Vpcs', 'vpc', 1000),
+    ('ec2', 'describe_subnets'): ('Subnets', 'subnet', 1000),
+    ('ec2', 'describe_network_interfaces'): ('NetworkInterfaces', 'network-interfaces', 1000),
+    ('ec2', 'describe_capacity_reservations'): ('CapacityReservations', 'odcr', 1000),
+    ('ec2', 'describe_reserved_instances'): ('ReservedInstances', 'ri', None),
+    ('lambda', 'list_functions'): ('Functions', 'lambda', 50),
+    ('rds', 'describe_db_instances'): ('DBInstances', 'rds', 100),
+    ('lightsail', 'get_instances'): ('instances', 'lightsail', 100),
+    ('iam', 'list_roles'): ('Roles', 'iam-roles', 100),
+    ('iam', 'list_users'): ('Users', 'iam-users', 100),
+    ('iam', 'list_policies'): ('Policies', 'iam-attached-policys', 100),
+    ('s3', 'list_buckets'): ('Buckets', 's3-buckets', None),
+    ('organizations', 'list_accounts'): ('Accounts', 'org', 20)
+}
+
+
+# One api shaped resource of an entry type, name is unique within the slice
+def make_resource(entry_type, name, account, region, rng):
+
+    created = '2019-10-01 00:00:00+00:00'
+
+    if entry_type == 'ec2':
+        return {'Instances': [{
+            'InstanceId': f'i-{name}',
+            'State': {'Name': rng.choice(['running', 'running', 'stopped'])},
+            'CpuOptions': {'CoreCount': rng.choice([1, 2, 4]), 'ThreadsPerCore': 2},
+            'InstanceType': rng.choice(['t3.micro', 'm5.large', 'c5.xlarge']),
+            'KeyName': f'key-{account}',
+            'PrivateIpAddress': f'10.0.{rng.randint(0, 255)}.{rng.randint(0, 255)}'
+        }]}
+    if entry_type == 'vpc':
+        return {'CidrBlock': '10.0.0.0/16', 'VpcId': f'vpc-{name}', 'DhcpOptionsId': 'dopt-1',
+                'InstanceTenancy': 'default'}
+    if entry_type == 'subnet':
+        return {'CidrBlock': '10.0.1.0/24', 'AvailabilityZone': f'{region}a', 'AvailabilityZoneId': 'az1',
+                'SubnetId': f'subnet-{name}', 'VpcId': 'vpc-1',
+                'SubnetArn': f'arn:aws:ec2:{region}:{account}:subnet/subnet-{name}',
+                'AvailableIpAddressCount': rng.randint(0, 250)}
+    if entry_type == 'network-interfaces':
+        return {'NetworkInterfaceId': f'eni-{name}', 'PrivateIpAddress': '10.0.1.10', 'Status': 'in-use',
+                'Attachment': {'Status': 'attached'}, 'InterfaceType': 'interface', 'Description': name}
+    if entry_type == 'odcr':
+        return {'CapacityReservationId': f'cr-{name}', 'AvailabilityZone': f'{region}a',
+                'AvailableInstanceCount': 1, 'TotalInstanceCount': 2, 'CreateDate': created,
+                'EbsOptimized': False, 'EndDateType': 'unlimited', 'EphemeralStorage': False,
+                'InstanceMatchCriteria': 'open', 'InstancePlatform': 'Linux/UNIX',
+                'InstanceType': 'm5.large', 'State': rng.choice(['active', 'active', 'expired', 'cancelled']),
+                'Tags': [], 'Tenancy': 'default'}
+    if entry_type == 'ri':
+        return {'ReservedInstancesId': f'ri-{name}', 'InstanceCount': 2, 'InstanceType': 'm5.large',
+                'Scope': 'Region', 'ProductDescription': 'Linux/UNIX', 'Start': created, 'End': created,
+                'InstanceTenancy': 'default', 'OfferingClass': 'standard',
+                'State': rng.choice(['active', 'retired', 'retired', 'retired'])}
+    if entry_type == 'lambda':
+        return {'FunctionName': name, 'FunctionArn': f'arn:aws:lambda:{region}:{account}:function:{name}',
+                'Runtime': rng.choice(['python3.7', 'nodejs10.x']), 'Timeout': 30,
+                'Role': f'arn:aws:iam::{account}:role/role-{name}', 'MemorySize': 128,
+                'LastModified': created}
+    if entry_type == 'rds':
+        return {'DBInstanceIdentifier': f'db-{name}', 'DBInstanceStatus': 'available',
+                'DBInstanceClass': 'db.t3.micro', 'Engine': 'mysql', 'MultiAZ': False,
+                'PubliclyAccessible': False}
+    if entry_type == 'lightsail':
+        return {'name': name, 'location': {'availabilityZone': f'{region}a'}, 'createdAt': created,
+                'blueprintName': 'Ubuntu', 'hardware': {'ramSizeInGb': 1, 'cpuCount': 1, 'disks': [{'sizeInGb': 40}]},
+                'publicIpAddress': '1.2.3.4'}
+    if entry_type == 'iam-roles':
+        return {'Arn': f'arn:aws:iam::{account}:role/{name}', 'RoleName': name, 'CreateDate': created}
+    if entry_type == 'iam-users':
+        return {'Arn': f'arn:aws:iam::{account}:user/{name}', 'UserName': name, 'CreateDate': created}
+    if entry_type == 'iam-attached-policys':
+        return {'Arn': f'arn:aws:iam::{account}:policy/{name}', 'PolicyName': name, 'AttachmentCount': 1}
+    if entry_type == 's3-buckets':
+        return {'Name': f'bucket-{account}-{name}', 'CreationDate': created}
+
+    raise ValueError(f'no synthetic {entry_type}')
+
+
+# N accounts x R regions x M resources per entry type. churn() replaces a
+# fraction of every slice with new resources, like a day of launches and
+# terminations.
+class SyntheticFleet(object):
+
+    def __init__(self, accounts, regions, resources, types=None, seed=1):
+        self.accounts = [str(111111111111 + n) for n in range(accounts)]
+        self.regions = ['us-east-1'] + [r for r in ['ap-southeast-2', 'eu-west-1', 'us-west-2',
+                                                    'ap-northeast-1', 'eu-central-1', 'sa-east-1',
+                                                    'ca-central-1'] if r != 'us-east-1'][:max(0, regions - 1)]
+        self.resources = resources
+        self.types = types or [t for _, t, _ in listings.values()]
+        self.seed = seed
+        self.generation = 0
+        self.slices = {}
+
+    def listing(self, entry_type, account, region):
+
+        if entry_type not in self.types or (entry_type in global_types and region != 'us-east-1'):
+            return []
+
+        if entry_type == 'org':
+            return [{'Id': a, 'Arn': f'arn:aws:organizations::{self.accounts[0]}:account/{a}', 'Name': a,
+                     'Email': f'{a}@example.com', 'Status': 'ACTIVE'} for a in self.accounts]
+
+        key = (entry_type, account, region)
+        if key not in self.slices:
+            rng = random.Random(f'{self.seed}|{key}')
+            self.slices[key] = [make_resource(entry_type, f'{n:06d}', account, region, rng)
+                                for n in range(self.resources)]
+
+        return self.slices[key]
+
+    def churn(self, fraction):
+
+        self.generation += 1
+        for (entry_type, account, region), resources in self.slices.items():
+            rng = random.Random(f'{self.seed}|{entry_type}|{account}|{region}|{self.generation}')
+            for n in rng.sample(range(len(resources)), int(len(resources) * fraction)):
+                resources[n] = make_resource(entry_type, f'{n:06d}g{self.generation}', account, region, rng)
+
+
+# Thread safe api call counter, keys are service.operation
+class CallCounter(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = Counter()
+
+    def add(self, key, n=1):
+        with self.lock:
+            self.calls[key] += n
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.calls)
+
+
+# Stand-in for a boto3 client of one service in one account and region
+class FakeClient(object):
+
+    def __init__(self, fleet, counter, service, account, region):
+        self.fleet = fleet
+        self.counter = counter
+        self.service = service
+        self.account = account
+        self.region = region
+
+    def can_paginate(self, operation):
+        return listings.get((self.service, operation), (None, None, None))[2] is not None
+
+    def get_paginator(self, operation):
+        return FakePaginator(self, operation)
+
+    # page of a listing, the whole listing unless a page size is passed. Only
+    # the state filter is understood, it's the one the collectors send.
+    def call(self, operation, page_size=None, token=None, filters=None):
+
+        if (self.service, operation) not in listings:
+            raise AttributeError(f'{self.service}.{operation} has no stand-in')
+
+        self.counter.add(f'{self.service}.{operation}')
+        result_key, entry_type, _ = listings[(self.service, operation)]
+        items = self.fleet.listing(entry_type, self.account, self.region)
+
+        for f in filters or []:
+            if f['Name'] != 'state':
+                raise ValueError(f"stand-in can't filter on {f['Name']}")
+            items = [i for i in items if i.get('State') in f['Values']]
+
+        start = int(token or 0)
+        end = len(items) if page_size is None else start + page_size
+        response = {result_key: items[start:end]}
+        if end < len(items):
+            response['NextToken'] = str(end)
+
+        size = len(json.dumps(response, default=str))
+        response['ResponseMetadata'] = {'HTTPHeaders': {'content-length': str(size)}, 'RetryAttempts': 0}
+        self.counter.add('bytes', size)
+
+        return response
+
+    def __getattr__(self, operation):
+
+        def api_call(**kwargs):
+            page_size = kwargs.get('MaxResults') or kwargs.get('MaxItems') or kwargs.get('MaxRecords')
+            return self.call(operation, page_size=page_size, token=kwargs.get('NextToken'),
+                             filters=kwargs.get('Filters'))
+
+        return api_call
+
+
+class FakePaginator(object):
+
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+
+        page_size = kwargs.get('PaginationConfig', {}).get('PageSize') or \
+            listings[(self.client.service, self.operation)][2]
+        token = None
+
+        while True:
+            page = self.client.call(self.operation, page_size=page_size, token=token,
+                                    filters=kwargs.get('Filters'))
+            yield page
+            token = page.get('NextToken')
+            if not token:
+                return
+
+
+# Evaluate a boto3.dynamodb.conditions condition against an item
+def matches(condition, item):
+
+    kind = type(condition).__name__
+    values = condition.get_expression()['values']
+
+    if kind == 'And':
+        return all(matches(v, item) for v in values)
+    if kind == 'Or':
+        return any(matches(v, item) for v in values)
+    if kind == 'Not':
+        return not matches(values[0], item)
+
+    name = values[0].name
+    if kind == 'Equals':
+        return item.get(name) == values[1]
+    if kind == 'NotEquals':
+        return item.get(name) != values[1]
+    if kind == 'BeginsWith':
+        return str(item.get(name, '')).startswith(values[1])
+    if kind == 'AttributeExists':
+        return name in item
+    if kind == 'AttributeNotExists':
+        return name not in item
+
+    raise NotImplementedError(f'condition {kind}')
+
+
+# Value a condition requires an attribute to equal, None if it doesn't
+def required_value(condition, name):
+
+    kind = type(condition).__name__
+    values = condition.get_expression()['values']
+
+    if kind == 'And':
+        for v in values:
+            value = required_value(v, name)
+            if value is not None:
+                return value
+    if kind == 'Equals' and values[0].name == name:
+        return values[1]
+
+    return None
+
+
+# Attribute names an expression refers to, with #placeholders resolved
+def expression_names(expression, names):
+    return [(names or {}).get(n.strip(), n.strip()) for n in expression.split(',') if n.strip()]
+
+
+class FakeTableMeta(object):
+
+    def __init__(self, table):
+        self.client = FakeTableClient(table)
+
+
+# The table's client as dynamo_batch_write uses it
+class FakeTableClient(object):
+
+    def __init__(self, table):
+        self.table = table
+
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity=None):
+
+        self.table.counter.add('dynamodb.batch_write_item')
+        units = 0
+        for requests in RequestItems.values():
+            for request in requests:
+                if 'PutRequest' in request:
+                    self.table.store(request['PutRequest']['Item'])
+                else:
+                    self.table.remove(request['DeleteRequest']['Key']['Id'])
+                units += 1
+
+        return {'ConsumedCapacity': [{'TableName': self.table.name, 'CapacityUnits': float(units)}],
+                'UnprocessedItems': {}}
+
+
+# In memory stand-in for the DynamoDB Table resource the lambdas use, with the
+# EntryType-index and EntryType-AccountRegion-index
+class FakeTable(object):
+
+    indexes = {
+        'EntryType-index': ['EntryType'],
+        'EntryType-AccountRegion-index': ['EntryType', 'AccountRegion']
+    }
+
+    def __init__(self, counter, name='benchmark', page_items=1000):
+        self.counter = counter
+        self.name = name
+        self.page_items = page_items
+        self.items = {}
+        self.by_type = defaultdict(set)
+        self.lock = threading.Lock()
+        self.meta = FakeTableMeta(self)
+
+    # callers hold the lock, keeps the Ids per EntryType up to date
+    def replace(self, item_id, item):
+
+        old = self.items.pop(item_id, None)
+        if old is not None and 'EntryType' in old:
+            self.by_type[old['EntryType']].discard(item_id)
+
+        if item is not None:
+            self.items[item_id] = item
+            if 'EntryType' in item:
+                self.by_type[item['EntryType']].add(item_id)
+
+    def store(self, item):
+        with self.lock:
+            self.replace(item['Id'], dict(item))
+
+    def remove(self, item_id):
+        with self.lock:
+            self.replace(item_id, None)
+
+    def get_item(self, Key, ConsistentRead=False, ProjectionExpression=None, ExpressionAttributeNames=None):
+
+        self.counter.add('dynamodb.get_item')
+        item = self.items.get(Key['Id'])
+        if item is None:
+            return {}
+        if ProjectionExpression:
+            keep = expression_names(ProjectionExpression, ExpressionAttributeNames)
+            item = {k: v for k, v in item.items() if k in keep}
+
+        return {'Item': dict(item)}
+
+    def put_item(self, Item, **kwargs):
+        self.counter.add('dynamodb.put_item')
+        self.store(Item)
+        return {}
+
+    def delete_item(self, Key, **kwargs):
+        self.counter.add('dynamodb.delete_item')
+        self.remove(Key['Id'])
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ConditionExpression=None, **kwargs):
+
+        self.counter.add('dynamodb.update_item')
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+
+        with self.lock:
+            item = self.items.get(Key['Id'])
+
+            if ConditionExpression == 'attribute_exists(Id)' and item is None:
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': ''}},
+                                  'UpdateItem')
+
+            item = dict(item or Key)
+            for action, body in re.findall(r'(SET|ADD|REMOVE)\s+(.*?)(?=\s+(?:SET|ADD|REMOVE)\s|$)',
+                                           UpdateExpression):
+                for clause in body.split(','):
+                    if action == 'SET':
+                        name, value = [p.strip() for p in clause.split('=')]
+                        item[names.get(name, name)] = values[value]
+                    elif action == 'ADD':
+                        name, value = clause.split()
+                        name = names.get(name, name)
+                        item[name] = item.get(name, 0) + values[value]
+                    else:
+                        item.pop(names.get(clause.strip(), clause.strip()), None)
+
+            self.replace(Key['Id'], item)
+
+        return {}
+
+    def query(self, IndexName, KeyConditionExpression, ProjectionExpression=None,
+              ExpressionAttributeNames=None, FilterExpression=None, ExclusiveStartKey=None, Limit=None):
+
+        self.counter.add('dynamodb.query')
+        keys = self.indexes[IndexName]
+        entry_type = required_value(KeyConditionExpression, 'EntryType')
+        with self.lock:
+            ids = self.by_type[entry_type] if entry_type is not None else list(self.items)
+            candidates = sorted((self.items[i] for i in ids if all(k in self.items[i] for k in keys)),
+                                key=lambda i: i['Id'])
+
+        if ExclusiveStartKey:
+            candidates = [i for i in candidates if i['Id'] > ExclusiveStartKey['Id']]
+
+        page = [i for i in candidates if matches(KeyConditionExpression, i)]
+        page_size = Limit or self.page_items
+        more = len(page) > page_size
+        page = page[:page_size]
+        last_key = {'Id': page[-1]['Id']} if more else None
+
+        if FilterExpression is not None:
+            page = [i for i in page if matches(FilterExpression, i)]
+        if ProjectionExpression:
+            keep = expression_names(ProjectionExpression, ExpressionAttributeNames)
+            page = [{k: v for k, v in i.items() if k in keep} for i in page]
+
+        response = {'Items': page, 'Count': len(page)}
+        if last_key:
+            response['LastEvaluatedKey'] = last_key
+
+        return response
+
+
+# Stand-in sqs client, keeps every message sent so the receiver can be fed them
+class FakeSQS(object):
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.lock = threading.Lock()
+        self.messages = []
+        self.delays = []
+
+    def send_message(self, QueueUrl, MessageAttributes, MessageBody, DelaySeconds=0):
+        self.counter.add('sqs.send_message')
+        with self.lock:
+            self.messages.append(MessageAttributes)
+            self.delays.append((MessageAttributes['AccountNumber']['StringValue'], DelaySeconds))
+        return {'MessageId': str(len(self.messages))}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.counter.add('sqs.send_message_batch')
+        with self.lock:
+            self.messages.extend(e['MessageAttributes'] for e in Entries)
+            self.delays.extend((e['MessageAttributes']['AccountNumber']['StringValue'], e.get('DelaySeconds', 0))
+                               for e in Entries)
+        return {'Successful': [{'Id': e['Id']} for e in Entries], 'Failed': []}
+
+    # How the messages sent so far become visible: the busiest second overall
+    # and for a single account, and the last second anything shows up
+    def burst(self):
+
+        with self.lock:
+            delays, self.delays = self.delays, []
+
+        per_second = Counter(d for _, d in delays)
+        per_account_second = Counter(delays)
+
+        return {
+            'peak_per_second': max(per_second.values(), default=0),
+            'peak_account_per_second': max(per_account_second.values(), default=0),
+            'spread_seconds': max(per_second, default=0)
+        }
+
+    # Everything sent so far as lambda sqs event records
+    def drain(self):
+
+        with self.lock:
+            messages, self.messages = self.messages, []
+
+        return [{
+            'messageId': str(n),
+            'receiptHandle': str(n),
+            'messageAttributes': {k: {'stringValue': v['StringValue'], 'dataType': 'String'}
+                                  for k, v in m.items()}
+        } for n, m in enumerate(messages)]
+
+
+# Lambda context with plenty of time left
+class FakeContext(object):
+
+    def get_remaining_time_in_millis(self):
+        return 900000
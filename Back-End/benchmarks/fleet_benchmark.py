@@ -0,0 +1,205 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# End to end benchmark of the cron fan-out and the receiver's collect and sync
+# pipeline over a synthetic org (see fleet.py). The real lambda handlers run
+# against local stand-ins for the AWS apis, every phase reports wall time,
+# peak memory, api calls and the bytes the describe/list calls returned.
+#   python Back-End/benchmarks/fleet_benchmark.py --accounts 5,10,20 --regions 2 --resources 100
+#   python Back-End/benchmarks/fleet_benchmark.py --json before.json
+# Comma separated values are swept so the json can be charted as scaling curves.
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import tracemalloc
+import contextlib
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'lambdas'))
+
+os.environ.update({
+    'ENV_ACCOUNTS': '111111111111',
+    'ENV_SOURCE_ACCOUNT': '111111111111',
+    'ENV_SOURCE_REGION': 'us-east-1',
+    'ENV_REGIONS': 'us-east-1',
+    'ENV_CROSS_ACCOUNT_ROLE': 'CrossAccountAccess',
+    'ENV_TABLE_NAME_MULTI': 'benchmark',
+    'ENV_SQSQUEUE': 'https://sqs.us-east-1.amazonaws.com/111111111111/benchmark',
+    'ENV_LOG_LEVEL': 'WARNING'
+})
+
+import fleet  # noqa: E402
+import send_sqs_message  # noqa: E402
+import receive_sqs_message  # noqa: E402
+
+
+# Point both handlers at the stand-ins for one synthetic fleet
+def install(synthetic, counter, table, queue):
+
+    accounts = ','.join(synthetic.accounts)
+    regions = ','.join(synthetic.regions)
+
+    send_sqs_message.accNumbers = accounts
+    send_sqs_message.regions = regions
+    send_sqs_message.source_account = synthetic.accounts[0]
+    send_sqs_message.sqs = queue
+    send_sqs_message.table = table
+
+    receive_sqs_message.source_account = synthetic.accounts[0]
+    receive_sqs_message.watched_regions = synthetic.regions
+    receive_sqs_message.get_table = lambda: table
+    receive_sqs_message.table_name_multi = table.name
+    receive_sqs_message.assume_sts_credentials = lambda account, role: None
+    receive_sqs_message.create_boto_client = \
+        lambda account, region, service, role: fleet.FakeClient(synthetic, counter, service, account, region)
+
+
+# Run a phase with stdout silenced, returns its wall time, peak memory, api calls, response bytes and result
+def measure(name, counter, memory, fn, *args):
+
+    before = counter.snapshot()
+    if memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        result = fn(*args)
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    calls = counter.snapshot()
+    calls.subtract(before)
+    response_bytes = calls.pop('bytes', 0)
+    calls = {k: v for k, v in sorted(calls.items()) if v}
+
+    return {'phase': name, 'seconds': round(seconds, 4), 'peak_bytes': peak,
+            'api_calls': sum(calls.values()), 'response_bytes': response_bytes, 'calls': calls}, result
+
+
+# cron through send_sqs_message, full skips pruning
+def fanout(queue, full=False):
+
+    query = {'function': 'cron'}
+    if full:
+        query['full'] = 'true'
+
+    result = json.loads(send_sqs_message.lambda_handler({'queryStringParameters': query}, None)['body'])
+    result.update(queue.burst())
+
+    return result
+
+
+# Every queued message through receive_sqs_message in sqs sized batches
+def receive(queue, batch_size):
+
+    records = queue.drain()
+    failures = 0
+    context = fleet.FakeContext()
+
+    for i in range(0, len(records), batch_size):
+        result = receive_sqs_message.lambda_handler({'Records': records[i:i + batch_size]}, context)
+        failures += len(result['batchItemFailures'])
+
+    return {'messages': len(records), 'failures': failures}
+
+
+def run(accounts, regions, resources, types, churn, batch_size, memory):
+
+    synthetic = fleet.SyntheticFleet(accounts, regions, resources, types)
+    counter = fleet.CallCounter()
+    table = fleet.FakeTable(counter)
+    queue = fleet.FakeSQS(counter)
+    install(synthetic, counter, table, queue)
+
+    phases = []
+
+    def phase(name, fn, *args):
+        stats, result = measure(name, counter, memory, fn, *args)
+        stats['result'] = result
+        phases.append(stats)
+
+    phase('fanout', fanout, queue, True)
+    phase('initial-sync', receive, queue, batch_size)
+    phase('fanout-pruned', fanout, queue)
+    phase('steady-sync', receive, queue, batch_size)
+    synthetic.churn(churn)
+    phase('fanout-churn', fanout, queue)
+    phase('churn-sync', receive, queue, batch_size)
+
+    return {
+        'accounts': accounts,
+        'regions': regions,
+        'resources': resources,
+        'churn': churn,
+        'items': len(table.items),
+        'phases': phases
+    }
+
+
+def print_run(run_result):
+
+    print(f"\n{run_result['accounts']} accounts x {run_result['regions']} regions x "
+          f"{run_result['resources']} resources, churn {run_result['churn']:.0%}, "
+          f"{run_result['items']} table items")
+    print(f"{'phase':<15}{'seconds':>10}{'peak MB':>10}{'api calls':>11}{'resp MB':>10}  busiest")
+
+    for p in run_result['phases']:
+        peak = f"{p['peak_bytes'] / 1024 / 1024:.1f}" if p['peak_bytes'] is not None else '-'
+        busiest = ', '.join(f'{k} {v}' for k, v in sorted(p['calls'].items(), key=lambda c: -c[1])[:3])
+        if 'peak_per_second' in p['result']:
+            burst = p['result']
+            busiest = (f"peak {burst['peak_per_second']}/s, {burst['peak_account_per_second']}/s per account "
+                       f"over {burst['spread_seconds']}s, {busiest}")
+        print(f"{p['phase']:<15}{p['seconds']:>10.3f}{peak:>10}{p['api_calls']:>11}"
+              f"{p['response_bytes'] / 1024 / 1024:>10.2f}  {busiest}")
+
+
+def number_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Synthetic fleet benchmark of the fan-out and sync pipeline')
+    parser.add_argument('--accounts', type=number_list, default=[10], help='accounts, comma separated to sweep')
+    parser.add_argument('--regions', type=number_list, default=[2], help='regions, comma separated to sweep')
+    parser.add_argument('--resources', type=number_list, default=[50],
+                        help='resources per entry type per account/region, comma separated to sweep')
+    parser.add_argument('--types', default=None, help='entry types to populate, default all')
+    parser.add_argument('--churn', type=float, default=0.05, help='fraction replaced before the churn sync')
+    parser.add_argument('--batch-size', type=int, default=10, help='sqs records per receiver invocation')
+    parser.add_argument('--no-memory', action='store_true', help="skip tracemalloc, it slows everything down")
+    parser.add_argument('--window', type=int, default=send_sqs_message.fanout_window_seconds,
+                        help='seconds the fan-out is spread over, 0 sends everything at once')
+    parser.add_argument('--account-rate', type=float, default=send_sqs_message.account_messages_per_second,
+                        help='most messages per account per second')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    send_sqs_message.fanout_window_seconds = args.window
+    send_sqs_message.account_messages_per_second = args.account_rate
+
+    types = args.types.split(',') if args.types else None
+    results = []
+
+    for accounts, regions, resources in itertools.product(args.accounts, args.regions, args.resources):
+        result = run(accounts, regions, resources, types, args.churn, args.batch_size, not args.no_memory)
+        print_run(result)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'\nwrote {args.json}')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,19 +3,70 @@
 
 import json
 import os
+import gzip
+import time
 import boto3
+import base64
+import re
 import decimal
-from boto3.dynamodb.conditions import Key
+import hashlib
+from collections import OrderedDict
+from boto3.dynamodb.types import TypeSerializer
+from boto3.dynamodb.conditions import Attr, Key, ConditionExpressionBuilder
 from botocore.exceptions import ClientError
 
+# brotli is optional, add it to the package to serve br to clients that accept it
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Dynamo number string to an int, or a float so fractions survive
+def plain_number(value):
+
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+# Dynamo AttributeValue straight to a plain json value, without going through
+# Decimal. Items come from the low level client so this is the only pass over them.
+def plain_attribute(attribute):
+
+    for kind, value in attribute.items():
+        if kind == 'S':
+            return value
+        if kind == 'N':
+            return plain_number(value)
+        if kind == 'M':
+            return plain_item(value)
+        if kind == 'L':
+            return [plain_attribute(v) for v in value]
+        if kind == 'SS':
+            return sorted(value)
+        if kind == 'NS':
+            return sorted(plain_number(v) for v in value)
+        if kind == 'B':
+            return base64.b64encode(value).decode('utf-8')
+        if kind == 'BS':
+            return [base64.b64encode(v).decode('utf-8') for v in value]
+        if kind == 'NULL':
+            return None
+
+        return value
+
 
-# Helper class for Dynamo
-class DecimalEncoder(json.JSONEncoder):
+# Strings are by far the most common so they skip the function call
+def plain_item(item):
+    return {k: v['S'] if 'S' in v else plain_attribute(v) for k, v in item.items()}
 
-    def default(self, obj):  # pylint: disable=E0202
-        if isinstance(obj, decimal.Decimal):
-            return int(obj)
-        return super(DecimalEncoder, self).default(obj)
+
+# Everything handed to reply is already plain, so the C encoder never calls back
+# into python
+def encode_json(message):
+    return json.dumps(message, separators=(',', ':'))
 
 
 # Try grab OS environment details from event
@@ -26,46 +77,433 @@ try:
 except Exception as e:
     print(f"No os.environment in lambda.... {e}")
 
-# Try Assign dynamo table
-try:
 
-    dynamodb = boto3.resource('dynamodb', region_name=source_region)
-    table = dynamodb.Table(table_name_multi)
-except Exception as e:
-    print(f"failed to speak to dynamo: {e}")
+# Optional setting, a missing or bad one falls back to its own default and
+# leaves the others alone
+def env_setting(name, default, parse=int, valid=None):
+
+    value = os.environ.get(name, '')
+    if not value:
+        return default
+
+    try:
+        parsed = parse(value)
+        if valid is not None and not valid(parsed):
+            raise ValueError('out of range')
+        return parsed
+    except Exception as e:
+        print(f"Error: bad {name} {value!r}, using {default}.... {e}")
+        return default
+
+
+# Optional limits and response cache settings for /search
+response_byte_budget = env_setting('ENV_RESPONSE_BYTE_BUDGET', 4 * 1024 * 1024, int, lambda v: v >= 1)
+max_page_limit = env_setting('ENV_MAX_PAGE_LIMIT', 1000, int, lambda v: v >= 1)
+response_cache_size = env_setting('ENV_RESPONSE_CACHE_SIZE', 32, int, lambda v: v >= 0)
+response_cache_bytes = env_setting('ENV_RESPONSE_CACHE_BYTES', 16 * 1024 * 1024, int, lambda v: v >= 0)
+response_cache_ttl = env_setting('ENV_RESPONSE_CACHE_TTL', 300, int, lambda v: v >= 0)
+compress_min_bytes = env_setting('ENV_COMPRESS_MIN_BYTES', 1024, int, lambda v: v >= 0)
+
+# Encoded responses kept between warm invocations, LRU ordered and bounded by
+# count and by the total size of their bodies
+response_cache = OrderedDict()
+response_cache_used = 0
 
+# Built on the first request and kept for warm invocations. Only the low
+# level client is used, queries skip the resource layer's Decimal
+# deserialisation (see plain_item) and its model never has to be loaded.
+client_dynamodb = None
 
-# Reply Message
-def reply(message, status_code):
 
-    return {
+def get_client_dynamodb():
+
+    global client_dynamodb
+    if client_dynamodb is None:
+        client_dynamodb = boto3.client('dynamodb', region_name=source_region)
+
+    return client_dynamodb
+
+
+# Content-Encoding to answer with for an Accept-Encoding header, br over gzip
+def pick_encoding(accept_encoding):
+
+    accepted = set()
+    for part in (accept_encoding or '').split(','):
+        coding, _, quality = part.partition(';')
+        quality = quality.strip().replace(' ', '')
+        try:
+            weight = float(quality[2:]) if quality.startswith('q=') else 1.0
+        except ValueError:
+            weight = 1.0
+        if weight > 0:
+            accepted.add(coding.strip().lower())
+
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+
+    return None
+
+
+def compress_body(body, encoding):
+
+    if encoding == 'br':
+        return brotli.compress(body, quality=4)
+
+    return gzip.compress(body, compresslevel=5)
+
+
+# Reply Message, compressed and base64 encoded for API Gateway when the
+# client accepts an encoding and the body is worth it
+def reply(message, status_code, headers=None, encoding=None):
+
+    response = {
         'statusCode': str(status_code),
-        'body': json.dumps(message, cls=DecimalEncoder),
+        'body': encode_json(message),
         'headers': {
             'Content-Type': 'application/json',
             'Access-Control-Allow-Credentials': 'true',
             'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Headers': 'Origin, X-Requested-With, Content-Type, Accept, Authorization'
+            'Access-Control-Allow-Headers': 'Origin, X-Requested-With, Content-Type, Accept, Authorization',
+            'Access-Control-Expose-Headers': 'X-Next-Cursor, ETag',
+            'Vary': 'Accept-Encoding'
         },
     }
 
+    if headers:
+        response['headers'].update(headers)
+
+    body = response['body'].encode('utf-8')
+    if encoding and len(body) >= compress_min_bytes:
+        response['body'] = base64.b64encode(compress_body(body, encoding)).decode('utf-8')
+        response['isBase64Encoded'] = True
+        response['headers']['Content-Encoding'] = encoding
+
+    return response
+
+
+# Opaque cursor wrapping dynamo's (low level) LastEvaluatedKey
+def encode_cursor(last_evaluated_key):
+
+    if not last_evaluated_key:
+        return None
 
-# Scan DynamoDB
-def query_table(entry_type):
+    raw = encode_json(last_evaluated_key)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('utf-8')
+
+
+def decode_cursor(cursor):
+
+    if not cursor:
+        return None
 
     try:
+        start_key = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+    except Exception:
+        raise ValueError('invalid cursor')
+
+    # AttributeValues, e.g {"Id": {"S": "..."}}
+    if not isinstance(start_key, dict) or not all(isinstance(v, dict) for v in start_key.values()):
+        raise ValueError('invalid cursor')
+
+    return start_key
+
+
+# Size of a query page on the wire, dynamo's typed json is a bit bigger than
+# what we send back so this errs on the safe side
+def page_bytes(result):
+
+    headers = result.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+    if 'content-length' in headers:
+        return int(headers['content-length'])
+
+    return len(encode_json(result['Items']))
+
+
+# Version of an entry type, bumped by the receiver every time it writes to it
+def get_entry_type_version(entry_type):
+
+    result = get_client_dynamodb().get_item(
+        TableName=table_name_multi,
+        Key={'Id': {'S': f'version#{entry_type}'}},
+        ProjectionExpression='#v',
+        ExpressionAttributeNames={'#v': 'Version'},
+        ConsistentRead=True
+    )
+
+    return int(result.get('Item', {}).get('Version', {}).get('N', 0))
+
+
+# ETag for a query, changes whenever the entry type version does
+def make_etag(entry_type, version, params):
+
+    query = json.dumps(params, sort_keys=True)
+    digest = hashlib.sha1(query.encode('utf-8')).hexdigest()[:16]
+
+    return f'"{entry_type}-{version}-{digest}"'
+
+
+# Cached response for an ETag and encoding if it is still inside the ttl
+def get_cached_response(key):
+
+    cached = response_cache.get(key)
+    if cached is None:
+        return None
+
+    if time.time() - cached['stored_at'] > response_cache_ttl:
+        drop_cached_response(key)
+        return None
+
+    response_cache.move_to_end(key)
+    return cached['response']
+
+
+def drop_cached_response(key):
+
+    global response_cache_used
+    cached = response_cache.pop(key, None)
+    if cached is not None:
+        response_cache_used -= cached['bytes']
+
+
+# Bodies over a quarter of the byte bound (uncompressed fetch-alls) aren't kept,
+# a few of them would push everything else out
+def put_cached_response(key, response):
+
+    global response_cache_used
+    size = len(response['body'])
+    if size > response_cache_bytes // 4:
+        return
+
+    drop_cached_response(key)
+    response_cache[key] = {'response': response, 'stored_at': time.time(), 'bytes': size}
+    response_cache_used += size
+
+    while len(response_cache) > response_cache_size or response_cache_used > response_cache_bytes:
+        drop_cached_response(next(iter(response_cache)))
+
+
+# Header lookup, API Gateway passes them as sent so the case varies
+def get_header(event, name):
+
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name.lower():
+            return value
+
+    return None
+
+
+# Attribute names callers can filter, project and sort on
+attribute_name_pattern = re.compile(r'^[A-Za-z][A-Za-z0-9_-]*$')
+
+
+# Shortcut parameters for the attributes every item has
+filter_shortcuts = {'account': 'AccountNumber', 'region': 'Region'}
 
-        # Scan dynamo for all Attribute data
-        current_items = table.query(
-            IndexName="EntryType-index",
-            KeyConditionExpression=Key("EntryType").eq(entry_type)
-        )
+
+def check_attribute_name(name):
+
+    if not attribute_name_pattern.match(name):
+        raise ValueError(f'invalid attribute name {name}')
+
+    return name
+
+
+# Equality on a query string value, numbers are stored as numbers so match either
+def attribute_equals(name, value):
+
+    condition = Attr(name).eq(value)
+
+    try:
+        number = decimal.Decimal(value)
+    except decimal.InvalidOperation:
+        return condition
+
+    if number.is_finite():
+        condition = condition | Attr(name).eq(number)
+
+    return condition
+
+
+# Query options for the filter and projection parameters, e.g
+# account=111111111111&region=us-east-1&filter.State=running&prefix.InstanceType=t3.&fields=InstanceId,State
+# account and region are filters rather than key conditions as the
+# EntryType-AccountRegion-index only projects the keys and content hash
+def build_query_options(params):
+
+    options = {}
+    conditions = []
+
+    for param, name in filter_shortcuts.items():
+        if params.get(param):
+            conditions.append(Attr(name).eq(params[param]))
+
+    for param in sorted(params):
+        value = params[param]
+        if param.startswith('filter.'):
+            conditions.append(attribute_equals(check_attribute_name(param[len('filter.'):]), value))
+        elif param.startswith('prefix.'):
+            conditions.append(Attr(check_attribute_name(param[len('prefix.'):])).begins_with(value))
+
+    if conditions:
+        condition = conditions[0]
+        for c in conditions[1:]:
+            condition = condition & c
+        options['FilterExpression'] = condition
+
+    if params.get('fields'):
+        fields = [check_attribute_name(f.strip()) for f in params['fields'].split(',') if f.strip()]
+        options['ProjectionExpression'] = ', '.join(f'#p{i}' for i in range(len(fields)))
+        options['ExpressionAttributeNames'] = {f'#p{i}': f for i, f in enumerate(fields)}
+
+    return options
+
+
+# Sort key list from e.g sort=Region,-vCPU (- for descending)
+def parse_sort(sort):
+
+    keys = []
+    for field in (sort or '').split(','):
+        field = field.strip()
+        if not field:
+            continue
+        descending = field.startswith('-')
+        keys.append((check_attribute_name(field.lstrip('-')), descending))
+
+    return keys
+
+
+# Numbers before strings so mixed attributes still sort
+def sort_value(item, name):
+
+    value = item[name]
+    if isinstance(value, (int, float, decimal.Decimal)):
+        return (0, value)
+
+    return (1, str(value))
+
+
+# Sort the returned items in lambda, one stable pass per key starting with the
+# last, items missing the attribute go last
+def sort_items(items, sort_keys):
+
+    for name, descending in reversed(sort_keys):
+        present = [i for i in items if name in i]
+        missing = [i for i in items if name not in i]
+        present.sort(key=lambda i: sort_value(i, name), reverse=descending)
+        items = present + missing
+
+    return items
+
+
+# Low level query request for an entry type, conditions are built the way the
+# resource layer would build them
+def build_query_request(entry_type, options=None):
+
+    options = options or {}
+    builder = ConditionExpressionBuilder()
+    serializer = TypeSerializer()
+
+    key = builder.build_expression(Key('EntryType').eq(entry_type), is_key_condition=True)
+    names = dict(key.attribute_name_placeholders)
+    values = dict(key.attribute_value_placeholders)
+
+    request = {
+        'TableName': table_name_multi,
+        'IndexName': 'EntryType-index',
+        'KeyConditionExpression': key.condition_expression
+    }
+
+    if options.get('FilterExpression') is not None:
+        built = builder.build_expression(options['FilterExpression'])
+        request['FilterExpression'] = built.condition_expression
+        names.update(built.attribute_name_placeholders)
+        values.update(built.attribute_value_placeholders)
+
+    if options.get('ProjectionExpression'):
+        request['ProjectionExpression'] = options['ProjectionExpression']
+        names.update(options['ExpressionAttributeNames'])
+
+    request['ExpressionAttributeNames'] = names
+    request['ExpressionAttributeValues'] = {k: serializer.serialize(v) for k, v in values.items()}
+
+    return request
+
+
+# Query one page of DynamoDB, items come back as plain json values
+def query_table(entry_type, limit=None, start_key=None, options=None):
+
+    try:
+
+        kwargs = build_query_request(entry_type, options)
+        if limit:
+            kwargs['Limit'] = limit
+        if start_key:
+            kwargs['ExclusiveStartKey'] = start_key
+
+        # Query dynamo for all Attribute data
+        current_items = get_client_dynamodb().query(**kwargs)
+        current_items['Items'] = [plain_item(i) for i in current_items['Items']]
 
         return current_items
 
     except ClientError as e:
         print("failed to query dynamodb table...")
         print(e)
+        raise e
+
+
+# Walk pages until the end of the entry type or until the byte budget is used
+def query_table_all(entry_type, start_key=None, byte_budget=None, options=None):
+
+    items = []
+    used = 0
+
+    while True:
+        result = query_table(entry_type, start_key=start_key, options=options)
+        items.extend(result['Items'])
+        used += page_bytes(result)
+        start_key = result.get('LastEvaluatedKey')
+
+        if not start_key or (byte_budget and used >= byte_budget):
+            return items, start_key
+
+
+# /summary serves the rollup records the receiver keeps per entry type, account and region
+def is_summary(event):
+    return (event.get('resource') or event.get('path') or '').rstrip('/').endswith('/summary')
+
+
+# Totals per entry type over the given rollups
+def merge_rollups(rollups):
+
+    totals = {}
+    for r in rollups:
+        total = totals.setdefault(r.get('RollupType', 'unknown'), {'Count': 0, 'Sums': {}, 'Dimensions': {}})
+        total['Count'] += r.get('Count', 0)
+
+        for name, value in r.get('Sums', {}).items():
+            total['Sums'][name] = total['Sums'].get(name, 0) + value
+
+        for name, values in r.get('Dimensions', {}).items():
+            dimension = total['Dimensions'].setdefault(name, {})
+            for value, count in values.items():
+                dimension[value] = dimension.get(value, 0) + count
+
+    return totals
+
+
+# Totals over every rollup the filters match, not just the page being returned.
+# Rollups are small and only the attributes merge_rollups reads are fetched.
+def summary_totals(options):
+
+    options = dict(options)
+    options['ProjectionExpression'] = '#t, #c, #s, #d'
+    options['ExpressionAttributeNames'] = {'#t': 'RollupType', '#c': 'Count', '#s': 'Sums', '#d': 'Dimensions'}
+
+    rollups, _ = query_table_all(entry_type='rollup', options=options)
+    return merge_rollups(rollups)
 
 
 # Default lambda
@@ -76,13 +514,91 @@ def lambda_handler(event, context):
         print(json.dumps(event))
 
         # variables
-        search_key = event['queryStringParameters']['scan']
+        params = event.get('queryStringParameters') or {}
+        summary = is_summary(event)
+
+        # e.g /summary?type=ec2&account=111111111111, the rest of the /search
+        # filters work the same
+        if summary:
+            params = dict(params)
+            if params.get('type'):
+                params['filter.RollupType'] = params.pop('type')
+            params['scan'] = 'rollup'
+
+        search_key = params['scan']
+        encoding = pick_encoding(get_header(event, 'Accept-Encoding'))
         print(f'variable passed: {search_key}')
-        result = query_table(entry_type=search_key)
-        print(f'result: {result}')
 
-        # create a response
-        return reply(message=result['Items'], status_code=200)
+        try:
+            start_key = decode_cursor(params.get('cursor'))
+            limit = int(params['limit']) if params.get('limit') else None
+            options = build_query_options(params)
+            sort_keys = parse_sort(params.get('sort'))
+        except ValueError as e:
+            return reply(message={'message': f'Error: {e}'}, status_code=400)
+
+        if limit is not None and not 1 <= limit <= max_page_limit:
+            return reply(message={'message': f'Error: limit must be between 1 and {max_page_limit}'},
+                         status_code=400)
+
+        # Unchanged since the client's copy or our cached copy, skip the query
+        version = get_entry_type_version(search_key)
+        etag = make_etag(search_key, version, params)
+        cache_headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+
+        if get_header(event, 'If-None-Match') == etag:
+            print(f'{search_key} not modified since version {version}')
+            response = reply(message='', status_code=304, headers=cache_headers)
+            response['body'] = ''
+            return response
+
+        cache_key = f'{etag}|{encoding}'
+        cached = get_cached_response(cache_key)
+        if cached is not None:
+            print(f'serving {search_key} version {version} from cache')
+            return cached
+
+        # One page of `limit` items
+        if limit:
+            result = query_table(entry_type=search_key,
+                                 limit=limit, start_key=start_key, options=options)
+            items = result['Items']
+            next_key = result.get('LastEvaluatedKey')
+
+        # Fetch all, bounded by the byte budget
+        else:
+            items, next_key = query_table_all(
+                entry_type=search_key, start_key=start_key, byte_budget=response_byte_budget,
+                options=options)
+
+        # Sorted within what this response returns, not across cursor pages
+        if sort_keys:
+            items = sort_items(items, sort_keys)
+
+        next_cursor = encode_cursor(next_key)
+        print(f'returning {len(items)} items, more: {next_cursor is not None}')
+
+        # Paged callers get an object with the cursor, plain callers keep
+        # getting the list (and the cursor as a header when truncated)
+        if summary:
+            # A complete, unprojected response already holds every rollup,
+            # otherwise page through them all
+            if start_key is None and next_cursor is None and not options.get('ProjectionExpression'):
+                totals = merge_rollups(items)
+            else:
+                totals = summary_totals(options)
+            response = reply(message={'Rollups': items, 'Totals': totals, 'nextCursor': next_cursor},
+                             status_code=200, headers=cache_headers, encoding=encoding)
+        elif 'limit' in params or 'cursor' in params or 'all' in params:
+            response = reply(message={'Items': items, 'nextCursor': next_cursor},
+                             status_code=200, headers=cache_headers, encoding=encoding)
+        else:
+            if next_cursor:
+                cache_headers['X-Next-Cursor'] = next_cursor
+            response = reply(message=items, status_code=200, headers=cache_headers, encoding=encoding)
+
+        put_cached_response(cache_key, response)
+        return response
 
     except ClientError as e:
         print("Unexpected error: %s" % e)
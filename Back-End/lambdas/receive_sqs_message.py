@@ -4,13 +4,28 @@
 import boto3
 import json
 import os
+import re
+import time
 import uuid
+import random
 import decimal
-import copy
-from ast import literal_eval
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import botocore.session
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from boto3.dynamodb.conditions import Attr, Key
 
+# Levelled logging, item dumps are DEBUG and only formatted when let through.
+# The lambda runtime already has a handler on the root logger.
+logger = logging.getLogger('receive_sqs_message')
+if not logging.getLogger().handlers:
+    logging.basicConfig(format='%(levelname)s %(message)s')
+
 
 # Helper class for Dynamo
 class DecimalEncoder(json.JSONEncoder):
@@ -28,16 +43,102 @@ try:
     table_name_multi = os.environ['ENV_TABLE_NAME_MULTI']
     queue_url = os.environ['ENV_SQSQUEUE']
 except Exception as e:
-    print(f'Error: No os.environment in lambda....: {e}')
+    logger.error('Error: No os.environment in lambda....: %s', e)
 
 
-# Try connect Clients
-try:
-    client_sqs = boto3.client('sqs', region_name=source_region)
-    dynamodb = boto3.resource('dynamodb', region_name=source_region)
-    table = dynamodb.Table(table_name_multi)
-except Exception as e:
-    print(f'Error: failed to speak to dynamo or sqs....: {e}')
+# Optional tuning value, a missing or bad one falls back to its own default
+# and leaves the others alone
+def env_setting(name, default, parse=int, valid=None):
+
+    value = os.environ.get(name, '')
+    if not value:
+        return default
+
+    try:
+        parsed = parse(value)
+        if valid is not None and not valid(parsed):
+            raise ValueError('out of range')
+        return parsed
+    except Exception as e:
+        logger.error('Error: bad %s %r, using %s....: %s', name, value, default, e)
+        return default
+
+
+def positive(value):
+    return value >= 1
+
+
+# Optional tuning for the STS credential cache, boto3 client pool, batch concurrency, writes and metrics
+sts_refresh_seconds = env_setting('ENV_STS_REFRESH_SECONDS', 300, int, lambda v: v >= 0)
+sts_cache_size = env_setting('ENV_STS_CACHE_SIZE', 256, int, positive)
+sts_cache_backend = env_setting('ENV_STS_CACHE_BACKEND', 'memory', str, lambda v: v in ('memory', 'dynamodb'))
+sts_cache_table_name = os.environ.get('ENV_STS_CACHE_TABLE', '')
+client_pool_size = env_setting('ENV_CLIENT_POOL_SIZE', 32, int, positive)
+client_pool_idle_seconds = env_setting('ENV_CLIENT_POOL_IDLE_SECONDS', 900, int, positive)
+client_pool_connections = env_setting('ENV_CLIENT_POOL_CONNECTIONS', 10, int, positive)
+record_concurrency = env_setting('ENV_RECORD_CONCURRENCY', 10, int, positive)
+write_threads = env_setting('ENV_WRITE_THREADS', 1, int, positive)
+write_max_retries = env_setting('ENV_WRITE_MAX_RETRIES', 8, int, lambda v: v >= 0)
+digest_max_age = env_setting('ENV_DIGEST_MAX_AGE', 3600, int, lambda v: v >= 0)
+metric_namespace = os.environ.get('ENV_METRIC_NAMESPACE', 'MultiAccountViewer')
+watched_regions = [r for r in os.environ.get('ENV_REGIONS', '').split(',') if r]
+region_workers = env_setting('ENV_REGION_WORKERS', 4, int, positive)
+region_deadline_ms = env_setting('ENV_REGION_DEADLINE_MS', 15000, int, lambda v: v >= 0)
+log_level = env_setting('ENV_LOG_LEVEL', logging.INFO, lambda v: logging.getLevelName(v.upper()),
+                        lambda v: isinstance(v, int))
+log_sample_rate = env_setting('ENV_LOG_SAMPLE_RATE', 0.0, float, lambda v: 0 <= v <= 1)
+
+logger.setLevel(log_level)
+
+
+# Clients are built on first use and kept for warm invocations, so a cold
+# start only pays for the ones its code path needs
+dynamodb = None
+client_sqs = None
+client_lock = threading.Lock()
+
+# boto3 resources aren't thread safe, every thread gets Table objects of its
+# own. They all sit on the one dynamodb resource and share its client, which is.
+thread_tables = threading.local()
+
+
+# This thread's Table of the given name
+def get_thread_table(name):
+
+    global dynamodb
+    tables = getattr(thread_tables, 'tables', None)
+    if tables is None:
+        tables = thread_tables.tables = {}
+
+    if name not in tables:
+        with client_lock:
+            if dynamodb is None:
+                dynamodb = boto3.resource('dynamodb', region_name=source_region)
+            tables[name] = dynamodb.Table(name)
+
+    return tables[name]
+
+
+# DynamoDB table, one Table object per worker thread
+def get_table():
+    return get_thread_table(table_name_multi)
+
+
+# Table of the shared STS credentials, only the receiver role can read it
+def get_credential_table():
+    return get_thread_table(sts_cache_table_name)
+
+
+# Only needed to hand unfinished regions back to the queue
+def get_client_sqs():
+
+    global client_sqs
+    if client_sqs is None:
+        with client_lock:
+            if client_sqs is None:
+                client_sqs = boto3.client('sqs', region_name=source_region)
+
+    return client_sqs
 
 
 # event = {
@@ -47,646 +148,1217 @@ except Exception as e:
 # }
 
 
-# Assume Role for sub accounts
-def assume_sts_role(account_to_assume, cross_account_role_name):
+# Log at DEBUG for ENV_LOG_SAMPLE_RATE of the invocations, ENV_LOG_LEVEL otherwise
+def sample_log_level():
+    logger.setLevel(logging.DEBUG if random.random() < log_sample_rate else log_level)
+
+
+# Exclusive time per phase of one slice, e.g Sts, ClientBuild, Paginate,
+# DynamoRead, Diff and Write. Time spent in a nested phase (STS inside a
+# client build) is taken out of the enclosing one.
+class PhaseTimer(object):
+
+    def __init__(self):
+        self.timings = OrderedDict()
+        self.stack = []
+        self.started = time.perf_counter()
+
+    def start(self, name):
+        self.stack.append([name, time.perf_counter(), 0.0])
+
+    def stop(self):
+        name, started, nested = self.stack.pop()
+        elapsed = time.perf_counter() - started
+        self.timings[name] = self.timings.get(name, 0.0) + elapsed - nested
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    def metrics(self):
+        metrics = {f'{name}Ms': round(seconds * 1000, 3) for name, seconds in self.timings.items()}
+        metrics['TotalMs'] = round((time.perf_counter() - self.started) * 1000, 3)
+        return metrics
+
+
+# Timer of the slice the current thread is working on
+phase_timers = threading.local()
 
-    # https://docs.aws.amazon.com/IAM/latest/UserGuide/id_roles_use_switch-role-api.html
-    sts_client = boto3.client('sts')
-    cross_account_role_arn = f'arn:aws:iam::{account_to_assume}:role/{cross_account_role_name}'
 
+# Time a phase against the current slice, a no-op outside of one
+@contextmanager
+def timed(name):
+
+    timer = getattr(phase_timers, 'current', None)
+    if timer is None:
+        yield
+        return
+
+    timer.start(name)
     try:
+        yield
+    finally:
+        timer.stop()
+
+
+# Time one (account, region, function) slice and emit its phases as EMF
+@contextmanager
+def timed_slice(account_number, region, sqs_fun):
+
+    timer = PhaseTimer()
+    previous = getattr(phase_timers, 'current', None)
+    phase_timers.current = timer
+
+    try:
+        yield timer
+    finally:
+        phase_timers.current = previous
+        emit_metrics(timer.metrics(), {'Account': account_number, 'Region': region, 'Function': sqs_fun},
+                     unit='Milliseconds')
+
+
+# Shared credential store in its own DynamoDB table (ENV_STS_CACHE_TABLE), lets
+# concurrent containers reuse each others STS credentials. The credentials are
+# live, so they stay out of the inventory table the api lambda reads and only
+# the receiver role is allowed on this one. ExpiresAt is the table's TTL.
+class DynamoCredentialBackend(object):
+
+    def __init__(self, get_dynamo_table):
+        self.get_table = get_dynamo_table
+
+    def get(self, key):
+        response = self.get_table().get_item(
+            Key={'Id': f'sts-credentials#{key[0]}#{key[1]}'})
+        item = response.get('Item')
+
+        if not item:
+            return None
+
+        return {
+            'AccessKeyId': item['AccessKeyId'],
+            'SecretAccessKey': item['SecretAccessKey'],
+            'SessionToken': item['SessionToken'],
+            'ExpiresAt': float(item['ExpiresAt'])
+        }
+
+    def put(self, key, credentials):
+        self.get_table().put_item(Item={
+            'Id': f'sts-credentials#{key[0]}#{key[1]}',
+            'AccessKeyId': credentials['AccessKeyId'],
+            'SecretAccessKey': credentials['SecretAccessKey'],
+            'SessionToken': credentials['SessionToken'],
+            'ExpiresAt': int(credentials['ExpiresAt'])
+        })
+
+
+# Expiry aware LRU cache of STS credentials keyed by (account, role), kept at
+# module level so it survives warm invocations of the lambda.
+class CredentialCache(object):
+
+    def __init__(self, max_size=256, refresh_seconds=300, backend=None):
+        self.max_size = max_size
+        self.refresh_seconds = refresh_seconds
+        self.backend = backend
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.sts_client = None
+        self.hits = 0
+        self.misses = 0
+        self.backend_hits = 0
+        self.evictions = 0
+
+    # Credentials are only usable if they won't expire inside the refresh window
+    def is_fresh(self, credentials):
+        return credentials['ExpiresAt'] - time.time() > self.refresh_seconds
+
+    def get(self, account_to_assume, cross_account_role_name):
+
+        key = (account_to_assume, cross_account_role_name)
+
+        with self.lock:
+            credentials = self.entries.get(key)
+            if credentials is not None and self.is_fresh(credentials):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return credentials
+            self.misses += 1
+
+        with timed('Sts'):
+            # Try the shared backend before going to STS
+            credentials = None
+            if self.backend is not None:
+                try:
+                    credentials = self.backend.get(key)
+                except Exception as e:
+                    logger.error('Error: credential backend read failed for %s - %s', key, e)
+                    credentials = None
+
+            if credentials is not None and self.is_fresh(credentials):
+                with self.lock:
+                    self.backend_hits += 1
+            else:
+                credentials = self.assume_role(
+                    account_to_assume, cross_account_role_name)
+                if self.backend is not None:
+                    try:
+                        self.backend.put(key, credentials)
+                    except Exception as e:
+                        logger.error('Error: credential backend write failed for %s - %s', key, e)
+
+        with self.lock:
+            self.entries[key] = credentials
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+        return credentials
+
+    def assume_role(self, account_to_assume, cross_account_role_name):
+
+        # https://docs.aws.amazon.com/IAM/latest/UserGuide/id_roles_use_switch-role-api.html
+        if self.sts_client is None:
+            with client_lock:
+                if self.sts_client is None:
+                    self.sts_client = boto3.client('sts')
+
+        cross_account_role_arn = f'arn:aws:iam::{account_to_assume}:role/{cross_account_role_name}'
 
         # Call the assume_role method of the STSConnection object and pass the role
         # ARN and a role session name.
-        credentials = sts_client.assume_role(
+        credentials = self.sts_client.assume_role(
             RoleArn=cross_account_role_arn,
             RoleSessionName='TemporaryRole'
-
         )['Credentials']
 
-        # Make temp creds
-        temporary_credentials = boto3.Session(
+        return {
+            'AccessKeyId': credentials['AccessKeyId'],
+            'SecretAccessKey': credentials['SecretAccessKey'],
+            'SessionToken': credentials['SessionToken'],
+            'ExpiresAt': credentials['Expiration'].timestamp()
+        }
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'backend_hits': self.backend_hits,
+                'evictions': self.evictions,
+                'size': len(self.entries)
+            }
+
+
+# Try build the credential cache
+try:
+    if sts_cache_backend == 'dynamodb':
+        if not sts_cache_table_name:
+            raise ValueError('ENV_STS_CACHE_TABLE is needed for the dynamodb backend')
+        credential_cache = CredentialCache(
+            sts_cache_size, sts_refresh_seconds, DynamoCredentialBackend(get_credential_table))
+    else:
+        credential_cache = CredentialCache(sts_cache_size, sts_refresh_seconds)
+except Exception as e:
+    logger.error('Error: failed to build credential cache, falling back to memory....: %s', e)
+    credential_cache = CredentialCache(sts_cache_size, sts_refresh_seconds)
+
+
+# Bounded pool of boto3 clients keyed by (account, region, service). Clients are
+# reused by warm invocations so the service model, endpoint resolution and the
+# urllib3 connection pool (and its keep-alive connections) are only set up once.
+# The pool lock only guards the dicts and STS is called outside of it, so
+# accounts don't wait on each others STS calls. A per key lock makes sure a
+# client is only built once when several threads ask for it at the same time.
+class ClientPool(object):
+
+    def __init__(self, max_size=32, idle_seconds=900, max_connections=10):
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        self.config = Config(max_pool_connections=max_connections)
+        self.entries = OrderedDict()
+        self.building = {}
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self.loader = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # New boto3 session sharing one botocore loader, so service models are
+    # only read and parsed once per container
+    def new_session(self, credentials=None):
+
+        botocore_session = botocore.session.get_session()
+        with self.lock:
+            if self.loader is None:
+                self.loader = botocore_session.get_component('data_loader')
+            else:
+                botocore_session.register_component('data_loader', self.loader)
+
+        if credentials is None:
+            return boto3.Session(botocore_session=botocore_session)
+
+        return boto3.Session(
             aws_access_key_id=credentials['AccessKeyId'],
             aws_secret_access_key=credentials['SecretAccessKey'],
             aws_session_token=credentials['SessionToken'],
+            botocore_session=botocore_session
         )
 
-        # return creds
-        return temporary_credentials
+    # One session per account and set of credentials, every client of an
+    # account shares it instead of carrying a session of its own
+    def get_session(self, account_number, credentials=None):
+
+        access_key = credentials['AccessKeyId'] if credentials else None
+
+        with self.lock:
+            entry = self.sessions.get(account_number)
+            if entry is not None and entry['access_key'] == access_key:
+                return entry['session']
+
+        entry = {'access_key': access_key, 'session': self.new_session(credentials)}
+
+        with self.lock:
+            current = self.sessions.get(account_number)
+            if current is not None and current['access_key'] == access_key:
+                return current['session']
+            self.sessions[account_number] = entry
+
+        return entry['session']
+
+    # Drop clients nobody has used for idle_seconds (oldest are at the front)
+    # or over max_size, then the sessions no pooled client uses any more
+    def evict(self, now):
+        evicted = 0
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if now - entry['last_used'] < self.idle_seconds and len(self.entries) <= self.max_size:
+                break
+            self.entries.popitem(last=False)
+            evicted += 1
+
+        if evicted:
+            self.evictions += evicted
+            in_use = {key[0] for key in self.entries}
+            for account_number in [a for a in self.sessions if a not in in_use]:
+                del self.sessions[account_number]
+
+    # Pooled client if there's one whose credentials aren't about to expire
+    def lookup(self, key, now):
+
+        entry = self.entries.get(key)
+        if entry is not None and entry['expires_at'] - now > credential_cache.refresh_seconds:
+            entry['last_used'] = now
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry['client']
+
+        return None
+
+    def build(self, account_number, region, service, cross_account_role):
+
+        with timed('ClientBuild'):
+            # Use boto3 on source account
+            if account_number == source_account:
+                session = self.get_session(account_number)
+                expires_at = float('inf')
+                logger.info('skipping STS for local account: %s', account_number)
+
+            else:
+                # Log into Accounts with STS
+                credentials = assume_sts_credentials(
+                    account_number, cross_account_role)
+                session = self.get_session(account_number, credentials)
+                expires_at = credentials['ExpiresAt']
+                logger.info('Logged into Account: %s, sts cache: %s', account_number, credential_cache.stats())
+
+            # Sessions aren't thread safe, and one build at a time means a
+            # service model is parsed once instead of by every thread at once.
+            # It's cpu bound, threads wouldn't overlap it anyway.
+            with self.build_lock:
+                client = session.client(service, region, config=self.config)
+
+        return client, expires_at
+
+    def get(self, account_number, region, service, cross_account_role):
+
+        key = (account_number, region, service)
+        now = time.time()
+
+        with self.lock:
+            self.evict(now)
+            client = self.lookup(key, now)
+            if client is not None:
+                return client
+            build_lock = self.building.setdefault(key, threading.Lock())
+
+        with build_lock:
+            try:
+                # Someone else may have built it while this thread waited
+                with self.lock:
+                    client = self.lookup(key, now)
+                    if client is not None:
+                        return client
+                    self.misses += 1
+
+                client, expires_at = self.build(account_number, region, service, cross_account_role)
+
+                with self.lock:
+                    self.entries[key] = {
+                        'client': client,
+                        'expires_at': expires_at,
+                        'last_used': now
+                    }
+                    self.entries.move_to_end(key)
+                    self.evict(now)
+
+                return client
+
+            finally:
+                with self.lock:
+                    if self.building.get(key) is build_lock:
+                        del self.building[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.entries),
+                'sessions': len(self.sessions)
+            }
+
+
+client_pool = ClientPool(
+    client_pool_size, client_pool_idle_seconds, client_pool_connections)
+
+
+# Get cached STS credentials for sub accounts
+def assume_sts_credentials(account_to_assume, cross_account_role_name):
+
+    try:
+
+        # Reuse cached credentials until they are about to expire
+        return credential_cache.get(account_to_assume, cross_account_role_name)
 
     except ClientError as e:
-        print(
-            f'Error: on Account: {account_to_assume} with Role: {cross_account_role_arn}')
-        print(f'{cross_account_role_name} might not exists in account?')
+        logger.error('Error: on Account: %s with Role: %s', account_to_assume, cross_account_role_name)
+        logger.error('%s might not exists in account?', cross_account_role_name)
         raise e
 
 
-# Create Boto Client
+# Create Boto Client, pooled per account, region and service
 def create_boto_client(account_number, region, service, cross_account_role):
 
-    # Use boto3 on source account
-    if account_number == source_account:
-        client = boto3.client(service, region)
-        print(f'skipping STS for local account: {account_number}')
-
-    else:
-        # Log into Accounts with STS
-        assume_creds = assume_sts_role(account_number, cross_account_role)
-        client = assume_creds.client(service, region)
-        print(f'Logged into Account: {account_number}')
+    client = client_pool.get(
+        account_number, region, service, cross_account_role)
 
     return client
 
 
-# Get Lambda Functions
-def get_all_lambda(account_number, region, cross_account_role):
+# Role name out of an iam role or instance profile arn
+def role_name_from_arn(arn):
+    return str(arn).split(':')[5].split('/')[1]
+
+
+# Role of an ec2 instance, boto hands the profile over as a dict
+def instance_role_name(instance):
+
+    profile = instance.get('IamInstanceProfile')
+    if not profile:
+        return ' '
+
+    return role_name_from_arn(profile['Arn'])
+
+
+# Cores x thread = vCPU count
+def instance_vcpu(instance):
+    return int(instance['CpuOptions']['CoreCount']) * int(instance['CpuOptions']['ThreadsPerCore'])
+
+
+def reservation_quantity(i):
+    return f"{i['AvailableInstanceCount']} of {i['TotalInstanceCount']}"
+
+
+# How every resource type is collected and stored:
+#   service, operation   boto3 client and paginated list call
+#   params               extra arguments for that call, filters go here so the
+#                        api drops what isn't stored instead of sending it over
+#   page_size            largest page the api hands out, fewer round trips
+#   result_key           list of resources in each page
+#   nested_key           list inside each of those, e.g the instances of a reservation
+#   keep                 resources to store, all by default. Also checked when
+#                        params filter on the same thing, it costs next to nothing
+#   natural_key          attribute that identifies a resource within its slice
+#   scope                'global' ones are listed once per account under us-east-1
+#   fields               attribute: (source, convert[, default]), source is a
+#                        dotted path into the resource or a function of it
+# EntryType, AccountNumber and Region are added to every record. A new resource
+# type only needs an entry here (and a rollup_specs one for /summary).
+collector_specs = {
+    'lambda': {
+        'service': 'lambda',
+        'operation': 'list_functions',
+        'page_size': 50,
+        'result_key': 'Functions',
+        'natural_key': 'FunctionArn',
+        'scope': 'regional',
+        'fields': {
+            'FunctionName': ('FunctionName', str),
+            'FunctionArn': ('FunctionArn', str),
+            'Runtime': ('Runtime', str),
+            'Timeout': ('Timeout', str),
+            'RoleName': (lambda i: role_name_from_arn(i['Role']), str),
+            'MemorySize': ('MemorySize', str),
+            'LastModified': ('LastModified', str)
+        }
+    },
+    'rds': {
+        'service': 'rds',
+        'operation': 'describe_db_instances',
+        'page_size': 100,
+        'result_key': 'DBInstances',
+        'natural_key': 'DBInstanceIdentifier',
+        'scope': 'regional',
+        'fields': {
+            'State': ('DBInstanceStatus', str),
+            'DBInstanceIdentifier': ('DBInstanceIdentifier', None),
+            'DBInstanceClass': ('DBInstanceClass', None),
+            'Engine': ('Engine', None),
+            'MultiAZ': ('MultiAZ', None),
+            'PubliclyAccessible': ('PubliclyAccessible', None)
+        }
+    },
+    'ec2': {
+        'service': 'ec2',
+        'operation': 'describe_instances',
+        'page_size': 1000,
+        'result_key': 'Reservations',
+        'nested_key': 'Instances',
+        'natural_key': 'InstanceId',
+        'scope': 'regional',
+        'fields': {
+            'InstanceId': ('InstanceId', None),
+            'State': ('State.Name', None),
+            'vCPU': (instance_vcpu, int),
+            'KeyName': ('KeyName', None, ' '),
+            'RoleName': (instance_role_name, str),
+            'PrivateIpAddress': ('PrivateIpAddress', None, ' '),
+            'PublicIpAddress': ('PublicIpAddress', None, ' '),
+            'InstancePlatform': ('Platform', None, 'Linux/UNIX'),
+            'InstanceType': ('InstanceType', None)
+        }
+    },
+    'iam-roles': {
+        'service': 'iam',
+        'operation': 'list_roles',
+        'page_size': 1000,
+        'result_key': 'Roles',
+        'natural_key': 'RoleName',
+        'scope': 'global',
+        'fields': {
+            'Arn': ('Arn', str),
+            'RoleName': ('RoleName', None),
+            'CreateDate': ('CreateDate', str)
+        }
+    },
+    'iam-users': {
+        'service': 'iam',
+        'operation': 'list_users',
+        'page_size': 1000,
+        'result_key': 'Users',
+        'natural_key': 'UserName',
+        'scope': 'global',
+        'fields': {
+            'Arn': ('Arn', str),
+            'UserName': ('UserName', str),
+            'PasswordLastUsed': ('PasswordLastUsed', str, ' '),
+            'CreateDate': ('CreateDate', str)
+        }
+    },
+    'iam-attached-policys': {
+        'service': 'iam',
+        'operation': 'list_policies',
+        'params': {'OnlyAttached': True},
+        'page_size': 1000,
+        'result_key': 'Policies',
+        'natural_key': 'Arn',
+        'scope': 'global',
+        'fields': {
+            'Arn': ('Arn', str),
+            'PolicyName': ('PolicyName', str),
+            'AttachmentCount': ('AttachmentCount', int)
+        }
+    },
+    'odcr': {
+        'service': 'ec2',
+        'operation': 'describe_capacity_reservations',
+        'params': {'Filters': [{'Name': 'state', 'Values': ['active']}]},
+        'page_size': 1000,
+        'result_key': 'CapacityReservations',
+        'keep': lambda i: i['State'] == 'active',
+        'natural_key': 'CapacityReservationId',
+        'scope': 'regional',
+        'fields': {
+            'AvailabilityZone': ('AvailabilityZone', None),
+            'AvailableInstanceCount': ('AvailableInstanceCount', None),
+            'CapacityReservationId': ('CapacityReservationId', None),
+            'Qty Available': (reservation_quantity, None),
+            'CreateDate': ('CreateDate', str),
+            'EbsOptimized': ('EbsOptimized', None),
+            'EndDateType': ('EndDateType', str),
+            'EphemeralStorage': ('EphemeralStorage', None),
+            'InstanceMatchCriteria': ('InstanceMatchCriteria', None),
+            'InstancePlatform': ('InstancePlatform', None),
+            'InstanceType': ('InstanceType', None),
+            'State': ('State', None),
+            'Tags': ('Tags', None),
+            'Tenancy': ('Tenancy', None),
+            'TotalInstanceCount': ('TotalInstanceCount', None)
+        }
+    },
+    'lightsail': {
+        'service': 'lightsail',
+        'operation': 'get_instances',
+        'result_key': 'instances',
+        'natural_key': 'Name',
+        'scope': 'regional',
+        'fields': {
+            'AvailabilityZone': ('location.availabilityZone', str),
+            'Name': ('name', str),
+            'CreateDate': ('createdAt', str),
+            'Blueprint': ('blueprintName', str),
+            'RAM in GB': ('hardware.ramSizeInGb', str),
+            'vCPU': ('hardware.cpuCount', str),
+            'SSD in GB': ('hardware.disks.0.sizeInGb', str),
+            'Public IP': ('publicIpAddress', str)
+        }
+    },
+    'org': {
+        'service': 'organizations',
+        'operation': 'list_accounts',
+        'page_size': 20,
+        'result_key': 'Accounts',
+        'keep': lambda i: i['Status'] == 'ACTIVE',
+        'natural_key': 'AccountNumber',
+        'scope': 'global',
+        'fields': {
+            # the member account, not the one the listing came from
+            'AccountNumber': ('Id', str),
+            'Arn': ('Arn', str),
+            'Name': ('Name', str),
+            'Email': ('Email', str),
+            'Status': ('Status', None)
+        }
+    },
+    'vpc': {
+        'service': 'ec2',
+        'operation': 'describe_vpcs',
+        'page_size': 1000,
+        'result_key': 'Vpcs',
+        'natural_key': 'VpcId',
+        'scope': 'regional',
+        'fields': {
+            'CidrBlock': ('CidrBlock', str),
+            'VpcId': ('VpcId', str),
+            'DhcpOptionsId': ('DhcpOptionsId', None),
+            'InstanceTenancy': ('InstanceTenancy', None)
+        }
+    },
+    'network-interfaces': {
+        'service': 'ec2',
+        'operation': 'describe_network_interfaces',
+        'page_size': 1000,
+        'result_key': 'NetworkInterfaces',
+        'natural_key': 'NetworkInterfaceId',
+        'scope': 'regional',
+        'fields': {
+            'PrivateIpAddress': ('PrivateIpAddress', str, ' '),
+            'PublicIp': ('Association.PublicIp', str, ' '),
+            'Status': ('Status', str, ' '),
+            'AttStatus': ('Attachment.Status', str, ' '),
+            'InterfaceType': ('InterfaceType', str, ' '),
+            'NetworkInterfaceId': ('NetworkInterfaceId', str, ' '),
+            'Description': ('Description', str, ' ')
+        }
+    },
+    'subnet': {
+        'service': 'ec2',
+        'operation': 'describe_subnets',
+        'page_size': 1000,
+        'result_key': 'Subnets',
+        'natural_key': 'SubnetId',
+        'scope': 'regional',
+        'fields': {
+            'CidrBlock': ('CidrBlock', str),
+            'AvailabilityZone': ('AvailabilityZone', None),
+            'AvailabilityZoneId': ('AvailabilityZoneId', None),
+            'SubnetId': ('SubnetId', str),
+            'VpcId': ('VpcId', str),
+            'SubnetArn': ('SubnetArn', str),
+            'AvailableIpAddressCount': ('AvailableIpAddressCount', None)
+        }
+    },
+    'ri': {
+        'service': 'ec2',
+        'operation': 'describe_reserved_instances',
+        'params': {'Filters': [{'Name': 'state', 'Values': ['active']}]},
+        'result_key': 'ReservedInstances',
+        'keep': lambda i: i['State'] == 'active',
+        'natural_key': 'ReservedInstancesId',
+        'scope': 'regional',
+        'fields': {
+            'InstanceCount': ('InstanceCount', str),
+            'InstanceType': ('InstanceType', None),
+            'Scope': ('Scope', None),
+            'ProductDescription': ('ProductDescription', str),
+            'ReservedInstancesId': ('ReservedInstancesId', str),
+            'Start': ('Start', str),
+            'End': ('End', str),
+            'InstanceTenancy': ('InstanceTenancy', None),
+            'OfferingClass': ('OfferingClass', None)
+        }
+    },
+    's3-buckets': {
+        'service': 's3',
+        'operation': 'list_buckets',
+        'result_key': 'Buckets',
+        'natural_key': 'Name',
+        'scope': 'global',
+        'fields': {
+            'Name': ('Name', str),
+            'CreationDate': ('CreationDate', str)
+        }
+    }
+}
+
 
-    # Init
-    var_list = []
+# Marks a field without default, the resource must have it
+required = object()
 
-    # Change boto client
-    client_lambda = create_boto_client(
-        account_number, region, 'lambda', cross_account_role)
-
-    # Page all ec2
-    paginator = client_lambda.get_paginator('list_functions')
-
-    for page in paginator.paginate():
-        for i in page['Functions']:
-
-            # clean role name out of arn
-            iam_role = str(i['Role']).split(':')[5].split('/')[1]
-
-            var_list.append(
-                {
-                    'EntryType': 'lambda',
-                    'Region': str(region),
-                    'FunctionName': str(i['FunctionName']),
-                    'FunctionArn': str(i['FunctionArn']),
-                    'Runtime': str(i['Runtime']),
-                    'AccountNumber': str(account_number),
-                    'Timeout': str(i['Timeout']),
-                    'RoleName': str(iam_role),
-                    'MemorySize': str(i['MemorySize']),
-                    'LastModified': str(i['LastModified'])
-                })
 
-    return var_list
+# Getter for a dotted path, falls back to the default at the first missing step
+def path_getter(path, default):
 
+    steps = [int(p) if p.isdigit() else p for p in path.split('.')]
 
-# Get RDS Function
-def get_all_rds(account_number, region, cross_account_role):
+    def get(i):
+        try:
+            for step in steps:
+                i = i[step]
+            return i
+        except (KeyError, IndexError):
+            if default is required:
+                raise
+            return default
 
-    # Init
-    var_list = []
+    return get
 
-    # Change boto client
-    client_rds = create_boto_client(
-        account_number, region, 'rds', cross_account_role)
-
-    # Page all db instances
-    paginator = client_rds.get_paginator('describe_db_instances')
-
-    for page in paginator.paginate():
-        for i in page['DBInstances']:
-            var_list.append(
-                {
-                    'EntryType': 'rds',
-                    'Region': str(region),
-                    'AccountNumber': str(account_number),
-                    'State': str(i['DBInstanceStatus']),
-                    'DBInstanceIdentifier': i['DBInstanceIdentifier'],
-                    'DBInstanceClass': i['DBInstanceClass'],
-                    'Engine': i['Engine'],
-                    'MultiAZ': i['MultiAZ'],
-                    'PubliclyAccessible': i['PubliclyAccessible']
-                })
 
-    return var_list
+# Getter for one field's source: a function of the resource, a dotted path or
+# a plain key (with or without a default)
+def field_getter(source, default):
 
+    if callable(source):
+        return source
+    if '.' in source:
+        return path_getter(source, default)
+    if default is required:
+        return lambda i: i[source]
 
-# Get EC2 Function
-def get_all_ec2(account_number, region, cross_account_role):
+    return lambda i: i.get(source, default)
 
-    # Init
-    var_list = []
 
-    # Use boto3 on source account
-    client_ec2 = create_boto_client(
-        account_number, region, 'ec2', cross_account_role)
+# Turn a collector spec into extract(resource, account, region) -> record, the
+# getters are built once at import and each record is one pass over them
+def build_extractor(entry_type, spec):
 
-    # Page all ec2
-    paginator = client_ec2.get_paginator('describe_instances')
+    fields = tuple(
+        (name, field_getter(field[0], field[2] if len(field) > 2 else required), field[1])
+        for name, field in spec['fields'].items())
+    global_scope = spec['scope'] == 'global'
 
-    for page in paginator.paginate():
-        for i in page['Reservations']:
+    def extract(r, account_number, region):
+        record = {
+            'EntryType': entry_type,
+            'AccountNumber': str(account_number),
+            'Region': 'us-east-1' if global_scope else str(region)
+        }
+        record.update({name: get(r) if convert is None else convert(get(r)) for name, get, convert in fields})
+        return record
 
-            # Check for IAM Role
-            checkIAMrole = i['Instances'][0].get('IamInstanceProfile', ' ')
+    return extract
 
-            # Convert from string to dict if not empty
-            if checkIAMrole != ' ':
-                python_dict = literal_eval(f'{checkIAMrole}')
-                full_role_name = python_dict['Arn']
 
-                # clean role name out of arn
-                iam_role = full_role_name.split(':')[5].split('/')[1]
-            else:
-                iam_role = ' '
-
-            # Get vCPU count
-            vcpu_core = i['Instances'][0]['CpuOptions']['CoreCount']
-            vcpu_thread = i['Instances'][0]['CpuOptions']['ThreadsPerCore']
-
-            # Cores x thread = vCPU count
-            vCPU = int(vcpu_core) * int(vcpu_thread)
-
-            var_list.append(
-                {
-                    'EntryType': 'ec2',
-                    'InstanceId': i['Instances'][0]['InstanceId'],
-                    'State': i['Instances'][0]['State']['Name'],
-                    'AccountNumber': str(account_number),
-                    'Region': str(region),
-                    'vCPU': int(vCPU),
-                    'KeyName': i['Instances'][0].get('KeyName', ' '),
-                    'RoleName': str(iam_role),
-                    'PrivateIpAddress': i['Instances'][0].get('PrivateIpAddress', ' '),
-                    'PublicIpAddress': i['Instances'][0].get('PublicIpAddress', ' '),
-                    'InstancePlatform': i['Instances'][0].get('Platform', 'Linux/UNIX'),
-                    'InstanceType': i['Instances'][0]['InstanceType']
-                })
+extractors = {f: build_extractor(f, spec) for f, spec in collector_specs.items()}
 
-    return var_list
 
+# Every page of a collector's list call. Paginators get the spec's page size,
+# calls without one (describe_reserved_instances, list_buckets) follow any
+# NextToken by hand so nothing is cut off if the api starts paging.
+def list_pages(client, spec):
 
-# Get IAM Roles Function
-def get_all_iam_roles(account_number, region, cross_account_role):
+    operation = spec['operation']
+    params = dict(spec.get('params', {}))
 
-    # Init
-    var_list = []
+    if client.can_paginate(operation):
+        pagination = {'PageSize': spec['page_size']} if spec.get('page_size') else {}
+        for page in client.get_paginator(operation).paginate(PaginationConfig=pagination, **params):
+            yield page
+        return
 
-    # Use boto3 on source account
-    client_iam = create_boto_client(
-        account_number, region, 'iam', cross_account_role)
-
-    # Page roles
-    paginator = client_iam.get_paginator('list_roles')
-
-    for page in paginator.paginate():
-        for i in page['Roles']:
-            var_list.append(
-                {
-                    'Arn': str(i['Arn']),
-                    'EntryType': 'iam-roles',
-                    'Region': 'us-east-1',
-                    'AccountNumber': str(account_number),
-                    'RoleName': i['RoleName'],
-                    'CreateDate': str(i['CreateDate'])
-                })
+    call = getattr(client, operation)
+    while True:
+        page = call(**params)
+        yield page
+        if not page.get('NextToken'):
+            return
+        params['NextToken'] = page['NextToken']
 
-    return var_list
 
+# Api calls (retries included), pages and response bytes of a collector
+def count_page(stats, page):
 
-# Get IAM Users Function
-def get_all_iam_users(account_number, region, cross_account_role):
+    metadata = page.get('ResponseMetadata', {})
+    stats['Pages'] += 1
+    stats['ApiCalls'] += 1 + metadata.get('RetryAttempts', 0)
 
-    # Init
-    var_list = []
+    length = metadata.get('HTTPHeaders', {}).get('content-length')
+    if length is not None:
+        stats['ResponseBytes'] += int(length)
+    else:
+        # chunked responses, near enough
+        stats['ResponseBytes'] += len(json.dumps(page, default=str))
 
-    # Use boto3 on source account
-    client_iam = create_boto_client(
-        account_number, region, 'iam', cross_account_role)
-
-    # Page users
-    paginator = client_iam.get_paginator('list_users')
-
-    for page in paginator.paginate():
-        for i in page['Users']:
-            var_list.append(
-                {
-                    'Arn': str(i['Arn']),
-                    'EntryType': 'iam-users',
-                    'AccountNumber': str(account_number),
-                    'Region': 'us-east-1',
-                    'UserName': str(i['UserName']),
-                    'PasswordLastUsed': str(i.get('PasswordLastUsed', ' ')),
-                    'CreateDate': str(i['CreateDate'])
-                })
 
-    return var_list
+# Records of every resource a collector spec lists in one account and region
+def collect_resources(account_number, region, sqs_fun, cross_account_role):
 
+    spec = collector_specs[sqs_fun]
+    extract = extractors[sqs_fun]
+    result_key = spec['result_key']
+    nested_key = spec.get('nested_key')
+    keep = spec.get('keep')
 
-# Get IAM Users Function
-def get_all_iam_attached_policys(account_number, region, cross_account_role):
+    client = create_boto_client(
+        account_number, region, spec['service'], cross_account_role)
 
-    # Init
     var_list = []
-
-    # Use boto3 on source account
-    client_iam = create_boto_client(
-        account_number, region, 'iam', cross_account_role)
-
-    # Page policys
-    paginator = client_iam.get_paginator('list_policies')
-
-    for page in paginator.paginate(OnlyAttached=True):
-        for i in page['Policies']:
-            var_list.append(
-                {
-                    'Arn': str(i['Arn']),
-                    'EntryType': 'iam-attached-policys',
-                    'AccountNumber': str(account_number),
-                    'Region': 'us-east-1',
-                    'PolicyName': str(i['PolicyName']),
-                    'AttachmentCount': int(i['AttachmentCount'])
-                })
+    listed = 0
+    stats = {'ApiCalls': 0, 'Pages': 0, 'ResponseBytes': 0}
+
+    for page in list_pages(client, spec):
+        count_page(stats, page)
+        for i in page[result_key]:
+            # every instance of a reservation, not just the first
+            for resource in (i[nested_key] if nested_key else (i,)):
+                listed += 1
+                if keep is None or keep(resource):
+                    var_list.append(extract(resource, account_number, region))
+
+    logger.info('%s in account %s, region %s: kept %d of %d listed, %d calls, %d pages, %d bytes', sqs_fun,
+                account_number, region, len(var_list), listed, stats['ApiCalls'], stats['Pages'],
+                stats['ResponseBytes'])
+    emit_metrics({'ApiCalls': stats['ApiCalls'], 'Pages': stats['Pages']}, {'Function': sqs_fun})
+    emit_metrics({'ResponseBytes': stats['ResponseBytes']}, {'Function': sqs_fun}, unit='Bytes')
 
     return var_list
 
 
-# Get OnDemand Capacity Reservations Function
-def get_all_odcr(account_number, region, cross_account_role):
+# Sort key of the EntryType-AccountRegion-index
+def account_region_key(account_number, region):
+    return f'{account_number}#{region}'
 
-    # Init
-    var_list = []
 
-    # Use boto3 on source account
-    client_ec2 = create_boto_client(
-        account_number, region, 'ec2', cross_account_role)
-
-    # Page all reservations
-    paginator = client_ec2.get_paginator('describe_capacity_reservations')
-
-    for page in paginator.paginate():
-        for i in page['CapacityReservations']:
-            if i['State'] == 'active':
-                var_list.append(
-                    {
-                        'EntryType': 'odcr',
-                        'AccountNumber': str(account_number),
-                        'Region': str(region),
-                        'AvailabilityZone': i['AvailabilityZone'],
-                        'AvailableInstanceCount': i['AvailableInstanceCount'],
-                        'CapacityReservationId': i['CapacityReservationId'],
-                        'Qty Available': f"{i['AvailableInstanceCount']} of {i['TotalInstanceCount']}",
-                        'CreateDate': str(i['CreateDate']),
-                        'EbsOptimized': i['EbsOptimized'],
-                        'EndDateType': str(i['EndDateType']),
-                        'EphemeralStorage': i['EphemeralStorage'],
-                        'InstanceMatchCriteria': i['InstanceMatchCriteria'],
-                        'InstancePlatform': i['InstancePlatform'],
-                        'InstanceType': i['InstanceType'],
-                        'State': i['State'],
-                        'Tags': i['Tags'],
-                        'Tenancy': i['Tenancy'],
-                        'TotalInstanceCount': i['TotalInstanceCount']
-                    })
+# Query every page, a single query stops at 1MB
+def query_all_pages(**kwargs):
 
-    return var_list
+    items = []
+    while True:
+        response = get_table().query(**kwargs)
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return items
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
 
 
-# Get Lightsail Instances Function
-def get_all_lightsail(account_number, region, cross_account_role):
+# Get data sitting in DynamoDB for each account
+def get_current_table(account_number, entry_type, region):
 
-    # Init
-    var_list = []
+    try:
+        # Query only this account and region's slice of the entry type, the
+        # index only projects Id and ContentHash which is all the diff needs
+        items = query_all_pages(
+            IndexName='EntryType-AccountRegion-index',
+            KeyConditionExpression=Key('EntryType').eq(entry_type) &
+            Key('AccountRegion').eq(account_region_key(account_number, region)),
+            ProjectionExpression='Id, ContentHash'
+        )
 
-    # Use boto3 on source account
-    client_lightsail = create_boto_client(
-        account_number, region, 'lightsail', cross_account_role)
-
-    # Page all reservations
-    paginator = client_lightsail.get_paginator('get_instances')
-
-    for page in paginator.paginate():
-        for i in page['instances']:
-            var_list.append(
-                {
-                    'EntryType': 'lightsail',
-                    'AccountNumber': str(account_number),
-                    'Region': str(region),
-                    'AvailabilityZone': str(i['location']['availabilityZone']),
-                    'Name': str(i['name']),
-                    'CreateDate': str(i['createdAt']),
-                    'Blueprint': str(i['blueprintName']),
-                    'RAM in GB': str(i['hardware']['ramSizeInGb']),
-                    'vCPU': str(i['hardware']['cpuCount']),
-                    'SSD in GB': str(i['hardware']['disks'][0]['sizeInGb']),
-                    'Public IP': str(i['publicIpAddress']),
-                })
+        logger.debug('items from db query: %s', items)
+        return items
 
-    return var_list
+    except ClientError as e:
+        logger.error('Error: failed to query dynamodb table... %s', e)
+    except Exception as e:
+        logger.error('Error: failed to query dynamodb table...%s', e)
 
 
-# Get Organizations Function
-def get_organizations(account_number, region, cross_account_role):
+# Get data sitting in DynamoDB without account look up
+def get_current_table_without_account(entry_type, region):
 
-    # Init
-    var_list = []
+    try:
+        # Scan dynamo for all data
+        items = query_all_pages(
+            IndexName='EntryType-index',
+            KeyConditionExpression=Key('EntryType').eq(entry_type),
+            FilterExpression=Attr('Region').eq(region),
+            ProjectionExpression='Id, ContentHash'
+        )
 
-    # Use boto3 on source account
-    client_org = create_boto_client(
-        account_number, region, 'organizations', cross_account_role)
-
-    # Page all org
-    paginator = client_org.get_paginator('list_accounts')
-
-    for page in paginator.paginate():
-        for i in page['Accounts']:
-            if i['Status'] == 'ACTIVE':
-                var_list.append(
-                    {
-                        'AccountNumber': str(i['Id']),
-                        'Arn': str(i['Arn']),
-                        'Region': 'us-east-1',
-                        'EntryType': 'org',
-                        'Name': str(i['Name']),
-                        'Email': str(i['Email']),
-                        'Status': i['Status']
-                    })
+        logger.debug('items from db query: %s', items)
+        return items
 
-    return var_list
+    except ClientError as e:
+        logger.error('Error: failed to query dynamodb table...%s', e)
+    except Exception as e:
+        logger.error('Error: failed to query dynamodb table...%s', e)
+
+
+# One off migration, adds AccountRegion to items written before the
+# EntryType-AccountRegion-index existed. Items that can't be placed in a slice
+# are deleted, the next sync writes them again. Runs until the lambda is close
+# to its timeout and returns a cursor to carry on from.
+def backfill_account_region(start_key=None, context=None):
+
+    updated = 0
+    deleted = 0
+    kwargs = {
+        'ProjectionExpression': 'Id, AccountNumber, #r',
+        'ExpressionAttributeNames': {'#r': 'Region'},
+        'FilterExpression': Attr('EntryType').exists() & Attr('AccountRegion').not_exists() &
+        Attr('EntryType').ne('slice-activity') & Attr('EntryType').ne('rollup')
+    }
 
+    while True:
+        if start_key:
+            kwargs['ExclusiveStartKey'] = start_key
+
+        response = get_table().scan(**kwargs)
+
+        for item in response['Items']:
+            if item.get('AccountNumber') and item.get('Region'):
+                get_table().update_item(
+                    Key={'Id': item['Id']},
+                    UpdateExpression='SET AccountRegion = :ar',
+                    ExpressionAttributeValues={
+                        ':ar': account_region_key(item['AccountNumber'], item['Region'])}
+                )
+                updated += 1
+            else:
+                get_table().delete_item(Key={'Id': item['Id']})
+                deleted += 1
 
-# Get VPC Function
-def get_all_vpc(account_number, region, cross_account_role):
+        start_key = response.get('LastEvaluatedKey')
+        if not start_key:
+            break
+        if context is not None and context.get_remaining_time_in_millis() < 10000:
+            break
 
-    # Init
-    var_list = []
+    result = {'updated': updated, 'deleted': deleted, 'start_key': start_key}
+    logger.info('backfill of AccountRegion: %s', result)
+    return result
 
-    # Use boto3 on source account
-    client_ec2 = create_boto_client(
-        account_number, region, 'ec2', cross_account_role)
-
-    # Page all vpc's
-    paginator = client_ec2.get_paginator('describe_vpcs')
-
-    for page in paginator.paginate():
-        for i in page['Vpcs']:
-            var_list.append(
-                {
-                    'EntryType': 'vpc',
-                    'AccountNumber': str(account_number),
-                    'Region': str(region),
-                    'CidrBlock': str(i['CidrBlock']),
-                    'VpcId': str(i['VpcId']),
-                    'DhcpOptionsId': i['DhcpOptionsId'],
-                    'InstanceTenancy': i['InstanceTenancy']
-                })
 
-    return var_list
+# Send one BatchWriteItem request (25 items max), retrying UnprocessedItems with
+# exponential backoff and full jitter, returns the write capacity consumed
+def dynamo_batch_write(requests):
 
+    # The resource's client takes plain python types like the Table does
+    client = get_table().meta.client
+    pending = {table_name_multi: requests}
+    consumed = 0.0
+    attempt = 0
 
-# Get All Network Interfaces Function
-def get_all_network_interfaces(account_number, region, cross_account_role):
+    while pending:
+        response = client.batch_write_item(
+            RequestItems=pending, ReturnConsumedCapacity='TOTAL')
 
-    # Init
-    var_list = []
+        for capacity in response.get('ConsumedCapacity', []):
+            consumed += capacity.get('CapacityUnits', 0)
 
-    # Use boto3 on source account
-    client_ec2 = create_boto_client(
-        account_number, region, 'ec2', cross_account_role)
-
-    # Page all vpc's
-    paginator = client_ec2.get_paginator('describe_network_interfaces')
-
-    for page in paginator.paginate():
-        for i in page['NetworkInterfaces']:
-            var_list.append(
-                {
-                    'EntryType': 'network-interfaces',
-                    'PrivateIpAddress': str(i.get('PrivateIpAddress', ' ')),
-                    'PublicIp': str(i.get('Association', {}).get('PublicIp', ' ')),
-                    'AccountNumber': str(account_number),
-                    'Region': str(region),
-                    'Status': str(i.get('Status', ' ')),
-                    'AttStatus': str(i.get('Attachment', {}).get('Status', ' ')),
-                    'InterfaceType': str(i.get('InterfaceType', ' ')),
-                    'NetworkInterfaceId': str(i.get('NetworkInterfaceId', ' ')),
-                    'Description': str(i.get('Description', ' '))
-                })
+        pending = response.get('UnprocessedItems') or {}
+        if pending:
+            attempt += 1
+            if attempt > write_max_retries:
+                raise Exception(
+                    f'{len(pending[table_name_multi])} items still unprocessed after {write_max_retries} retries')
+            time.sleep(random.uniform(0, min(5.0, 0.05 * 2 ** attempt)))
 
-    return var_list
+    return consumed
 
 
-# Get Subnet Function
-def get_all_subnets(account_number, region, cross_account_role):
+# DynamoDB put and delete items in 25 item batches, optionally spread across
+# ENV_WRITE_THREADS threads, returns the write capacity units consumed
+def dynamo_batch_apply(put_items, delete_ids):
 
-    # Init
-    var_list = []
+    requests = [{'PutRequest': {'Item': i}} for i in put_items]
+    requests += [{'DeleteRequest': {'Key': {'Id': i}}} for i in delete_ids]
+    batches = [requests[i:i + 25] for i in range(0, len(requests), 25)]
 
-    # Use boto3 on source account
-    client_ec2 = create_boto_client(
-        account_number, region, 'ec2', cross_account_role)
-
-    # No paginator for subnets
-    # paginator = client_ec2.get_paginator('describe_subnets')
-    result = client_ec2.describe_subnets()
-
-    for i in result['Subnets']:
-        var_list.append(
-            {
-                'EntryType': 'subnet',
-                'AccountNumber': str(account_number),
-                'Region': region,
-                'CidrBlock': str(i['CidrBlock']),
-                'AvailabilityZone': i['AvailabilityZone'],
-                'AvailabilityZoneId': i['AvailabilityZoneId'],
-                'SubnetId': str(i['SubnetId']),
-                'VpcId': str(i['VpcId']),
-                'SubnetArn': str(i['SubnetArn']),
-                'AvailableIpAddressCount': i['AvailableIpAddressCount']
-            })
+    if write_threads > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=min(write_threads, len(batches))) as executor:
+            return sum(executor.map(dynamo_batch_write, batches))
 
-    return var_list
+    return sum(dynamo_batch_write(b) for b in batches)
 
 
-# Get Reserved Instances
-def get_all_ris(account_number, region, cross_account_role):
+# Print metrics as CloudWatch Embedded Metric Format, no api calls needed
+def emit_metrics(metrics, dimensions, unit='Count'):
 
-    # Init
-    var_list = []
+    payload = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': metric_namespace,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit} for name in metrics]
+            }]
+        }
+    }
+    payload.update(dimensions)
+    payload.update(metrics)
 
-    # Use boto3 on source account
-    client_ec2 = create_boto_client(
-        account_number, region, 'ec2', cross_account_role)
-
-    # No paginator for reservations
-    # paginator = client_ec2.get_paginator('')
-    result = client_ec2.describe_reserved_instances()
-
-    for i in result['ReservedInstances']:
-        # only get active ones
-        if i['State'] == 'active':
-            var_list.append(
-                {
-                    'EntryType': 'ri',
-                    'AccountNumber': str(account_number),
-                    'InstanceCount': str(i['InstanceCount']),
-                    'InstanceType': i['InstanceType'],
-                    'Scope': i['Scope'],
-                    'ProductDescription': str(i['ProductDescription']),
-                    'ReservedInstancesId': str(i['ReservedInstancesId']),
-                    'Start': str(i['Start']),
-                    'End': str(i['End']),
-                    'InstanceTenancy': i['InstanceTenancy'],
-                    'OfferingClass': i['OfferingClass']
-                })
+    print(json.dumps(payload))
 
-    return var_list
 
+# Order independent digest of a slice's collected records
+def slice_digest(records):
 
-# Get S3 Buckets
-def get_all_s3_buckets(account_number, region, cross_account_role):
+    entries = sorted(f"{r['Id']}:{r['ContentHash']}" for r in records)
+    return hashlib.sha1('\n'.join(entries).encode('utf-8')).hexdigest()
 
-    # Init
-    var_list = []
 
-    # Use boto3 on source account
-    client_s3 = create_boto_client(
-        account_number, region, 's3', cross_account_role)
+# Id of the digest record for an (account, region, function) slice
+def slice_record_id(sqs_fun, account_number, region):
+    return f'slice#{sqs_fun}#{account_number}#{region}'
 
-    # No paginator for listing buckets
-    # paginator = client_ec2.get_paginator('')
-    result = client_s3.list_buckets()
 
-    for i in result['Buckets']:
-        var_list.append(
-            {
-                'Name': str(i['Name']),
-                'EntryType': 's3-buckets',
-                'AccountNumber': str(account_number),
-                'Region': 'us-east-1',
-                'CreationDate': str(i['CreationDate'])
-            })
+# Last digest stored for a slice, or None
+def get_slice_record(sqs_fun, account_number, region):
 
-    return var_list
+    response = get_table().get_item(
+        Key={'Id': slice_record_id(sqs_fun, account_number, region)},
+        ConsistentRead=True
+    )
 
+    return response.get('Item')
 
-# Get data sitting in DynamoDB for each account
-def get_current_table(account_number, entry_type, region):
 
-    try:
-        # Scan dynamo for all data
-        response = table.query(
-            IndexName='EntryType-index',
-            KeyConditionExpression=Key('EntryType').eq(entry_type),
-            FilterExpression=Attr('AccountNumber').eq(account_number) &
-            Attr('Region').eq(region)
-        )
+# Record a collection of a slice. The record doubles as the activity map
+# send_sqs_message prunes empty slices with, it is listed under the
+# slice-activity EntryType but has no AccountRegion so it stays out of the
+# slice index. The digest is only passed after a full sync went through.
+def update_slice_record(sqs_fun, account_number, region, result_count, digest=None):
+
+    now = int(time.time())
+    expression = 'SET EntryType = :e, AccountNumber = :a, #r = :r, #f = :f, ResultCount = :c, CollectedAt = :t'
+    values = {
+        ':e': 'slice-activity',
+        ':a': account_number,
+        ':r': region,
+        ':f': sqs_fun,
+        ':c': result_count,
+        ':t': now
+    }
 
-        print(f"items from db query: {response['Items']}")
-        return response['Items']
+    if result_count > 0:
+        expression += ', LastNonEmptyAt = :t'
 
-    except ClientError as e:
-        print(f'Error: failed to query dynamodb table... {e}')
-    except Exception as e:
-        print(f'Error: failed to query dynamodb table...{e}')
+    if digest is not None:
+        expression += ', Digest = :d, VerifiedAt = :t'
+        values[':d'] = digest
 
+    get_table().update_item(
+        Key={'Id': slice_record_id(sqs_fun, account_number, region)},
+        UpdateExpression=expression,
+        ExpressionAttributeNames={'#r': 'Region', '#f': 'Function'},
+        ExpressionAttributeValues=values
+    )
 
-# Get data sitting in DynamoDB without account look up
-def get_current_table_without_account(entry_type, region):
 
-    try:
-        # Scan dynamo for all data
-        response = table.query(
-            IndexName='EntryType-index',
-            KeyConditionExpression=Key('EntryType').eq(entry_type),
-            FilterExpression=Attr('Region').eq(region)
-        )
+# Bump the version counter of an entry type so list_table drops cached responses,
+# the item has no EntryType so it stays out of the EntryType-index. Failures are
+# raised, list_table's ETags only change with this version so callers must not
+# record the slice as synced without it.
+def bump_entry_type_version(entry_type):
 
-        print(f"items from db query: {response['Items']}")
-        return response['Items']
+    get_table().update_item(
+        Key={'Id': f'version#{entry_type}'},
+        UpdateExpression='ADD #v :one',
+        ExpressionAttributeNames={'#v': 'Version'},
+        ExpressionAttributeValues={':one': 1}
+    )
 
-    except ClientError as e:
-        print(f'Error: failed to query dynamodb table...{e}')
-    except Exception as e:
-        print(f'Error: failed to query dynamodb table...{e}')
 
+# Dimensions counted and attributes summed in the rollup of an entry type,
+# every type gets a Count
+rollup_specs = {
+    'ec2': {'dimensions': ['InstanceType', 'State', 'InstancePlatform'], 'sums': ['vCPU']},
+    'lambda': {'dimensions': ['Runtime'], 'sums': []},
+    'rds': {'dimensions': ['Engine', 'State', 'DBInstanceClass'], 'sums': []},
+    'odcr': {'dimensions': ['InstanceType', 'InstancePlatform'], 'sums': ['TotalInstanceCount', 'AvailableInstanceCount']},
+    'ri': {'dimensions': ['InstanceType', 'Scope'], 'sums': ['InstanceCount']},
+    'lightsail': {'dimensions': ['Blueprint'], 'sums': ['vCPU']}
+}
 
-# DynamoDB Create Item
-def dynamo_create_item(dynamodb_item):
 
-    try:
+# Id of the rollup record for an (entry type, account, region) slice
+def rollup_record_id(sqs_fun, account_number, region):
+    return f'rollup#{sqs_fun}#{account_number}#{region}'
 
-        # Put item
-        response = table.put_item(Item=dynamodb_item)
 
-        print(f'Sucessfully added {dynamodb_item}')
-        return response
+# Counts and sums over the collected records of a slice
+def build_rollup(sqs_fun, account_number, region, records):
 
-    except ClientError as e:
-        print(f'Error: failed to add {dynamodb_item} - {e}')
-    except Exception as e:
-        print(f'Error: creating item {dynamodb_item} - {e}')
+    spec = rollup_specs.get(sqs_fun, {'dimensions': [], 'sums': []})
+    dimensions = {d: {} for d in spec['dimensions']}
+    sums = {a: decimal.Decimal(0) for a in spec['sums']}
 
+    for r in records:
+        for d in spec['dimensions']:
+            value = str(r.get(d) or 'unknown')
+            dimensions[d][value] = dimensions[d].get(value, 0) + 1
+        for a in spec['sums']:
+            try:
+                sums[a] += decimal.Decimal(str(r.get(a) or 0))
+            except decimal.InvalidOperation:
+                pass
 
-# DynamoDB Delete Item
-def dynamo_delete_item(dynamodb_item):
+    return {
+        'Id': rollup_record_id(sqs_fun, account_number, region),
+        'EntryType': 'rollup',
+        'RollupType': sqs_fun,
+        'AccountNumber': account_number,
+        'Region': region,
+        'Count': len(records),
+        'Dimensions': dimensions,
+        'Sums': sums,
+        'UpdatedAt': int(time.time())
+    }
 
-    try:
 
-        response = table.delete_item(
-            Key={
-                'Id': dynamodb_item
-            })
+# Replace the rollup of a slice with one put (or delete once it is empty) and
+# let list_table know its cached /summary responses are stale. No EntryType
+# index projection is needed, the rollups are read back from EntryType-index.
+def write_rollup(sqs_fun, account_number, region, records):
 
-        print(f'Sucessfully deleted {dynamodb_item}')
-        return response
+    if records:
+        get_table().put_item(Item=build_rollup(sqs_fun, account_number, region, records))
+    else:
+        get_table().delete_item(Key={'Id': rollup_record_id(sqs_fun, account_number, region)})
 
-    except ClientError as e:
-        print(f'Error: Failed ON ID: {dynamodb_item} - {e}')
+    bump_entry_type_version('rollup')
 
 
 # delete all items in table, function not used but good for testing
 def dynamo_delete_all_items():
-    scan = table.scan(
+    scan = get_table().scan(
         ProjectionExpression='#k',
         ExpressionAttributeNames={
             '#k': 'Id'
         }
     )
 
-    with table.batch_writer() as batch:
+    with get_table().batch_writer() as batch:
         for each in scan['Items']:
             batch.delete_item(Key=each)
 
 
+# Result of diffing the current boto records against the items in dynamodb.
+# added, changed and unchanged are boto records, removed are stored items.
+Changeset = namedtuple('Changeset', ['added', 'changed', 'removed', 'unchanged'])
+
+
+# Attribute that identifies a resource within its account and region, per function
+natural_keys = {f: spec['natural_key'] for f, spec in collector_specs.items()}
+
+
+# Deterministic Id from (EntryType, account, region, natural key), so the same
+# resource always lands on the same item however often it is synced
+def item_id(entry_type, account_number, region, natural_key):
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f'{entry_type}|{account_number}|{region}|{natural_key}'))
+
+
+# Dynamo hands numbers back as Decimal, make them compare equal to boto values
+def fingerprint_default(obj):
+    if isinstance(obj, decimal.Decimal):
+        if obj == obj.to_integral_value():
+            return int(obj)
+        return float(obj)
+    return str(obj)
+
+
+# Hashable fingerprint of a record as it is stored in dynamodb, i.e without Id
+# and with empty values stripped, so boto records and dynamo items line up.
+# Stored on every item as its ContentHash.
+def record_fingerprint(record):
+
+    stored = {k: v for k, v in record.items() if v and k not in ('Id', 'ContentHash')}
+    canonical = json.dumps(stored, sort_keys=True, separators=(',', ':'),
+                           default=fingerprint_default)
+
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+# Diff boto records against dynamodb items in O(n+m), matched on Id and
+# compared on ContentHash alone, dynamo items only need Id and ContentHash
+def diff_records(boto_list, dynamo_list):
+
+    stored = {item['Id']: item for item in dynamo_list}
+
+    # last one wins if boto hands the same resource back twice
+    current = {record['Id']: record for record in boto_list}
+
+    added = []
+    changed = []
+    unchanged = []
+    for record_id, record in current.items():
+        item = stored.pop(record_id, None)
+        if item is None:
+            added.append(record)
+        elif item.get('ContentHash') != record['ContentHash']:
+            changed.append(record)
+        else:
+            unchanged.append(record)
+
+    removed = list(stored.values())
+
+    return Changeset(added=added, changed=changed, removed=removed, unchanged=unchanged)
+
+
 # compare lists in dynamodb and boto3 calls
-def compare_lists_and_update(boto_list, dynamo_list, pop_list):
-
-    # remove Id key to compare current boto calls
-    for i in pop_list:
-        i.pop('Id')
-
-    if len(boto_list) >= 1:
-        for r in boto_list:
-            if r not in pop_list:
-                print('new item, updating entries now...')
-                r.update({'Id': str(uuid.uuid4())})
-                # Strip empty values
-                strip_empty_values = {k: v for k, v in r.items() if v}
-                dynamo_create_item(strip_empty_values)
-            else:
-                print('no update needed...')
-    else:
-        # Boto list has no values
-        print('list empty, skipping')
-
-    if len(dynamo_list) >= 1:
-        for i in dynamo_list:
-            old_id = i['Id']
-            i.pop('Id')
-            if i not in boto_list:
-                print('deleting entry as not current or present in boto call')
-                i.update({'Id': old_id})
-                dynamo_delete_item(i['Id'])
-            else:
-                print('item is in boto list, skipping')
-    else:
-        # Boto list has no values
-        print('list empty, skipping')
+def compare_lists_and_update(boto_list, dynamo_list):
+
+    with timed('Diff'):
+        changeset = diff_records(boto_list, dynamo_list)
+    logger.info('changeset: %d added, %d changed, %d removed, %d unchanged', len(changeset.added),
+                len(changeset.changed), len(changeset.removed), len(changeset.unchanged))
+
+    # New and changed records are both a single put on their deterministic Id
+    put_items = []
+    for r in changeset.added + changeset.changed:
+        # Strip empty values
+        strip_empty_values = {k: v for k, v in r.items() if v}
+        put_items.append(strip_empty_values)
+
+    delete_ids = [i['Id'] for i in changeset.removed]
+
+    with timed('Write'):
+        consumed = dynamo_batch_apply(put_items, delete_ids)
+    logger.info('consumed %s write capacity units', consumed)
+
+    return changeset
 
 
 # Reply message
@@ -704,131 +1376,461 @@ def reply(message, status_code):
     }
 
 
+# Global API that only live in us-east-1, e.g IAM, S3 etc
+global_functions = [f for f, spec in collector_specs.items() if spec['scope'] == 'global']
+
+
+# Functions the ec2-family message runs together with one session
+ec2_family_functions = ['vpc', 'subnet', 'network-interfaces', 'ec2', 'odcr', 'ri']
+
+
+# Get Current Boto Data for a function
+def collect_function(account_number, region, sqs_fun, cross_account_role):
+
+    if sqs_fun not in collector_specs:
+        raise Exception(f'no collector for function {sqs_fun}')
+
+    # Global services are listed from us-east-1
+    if sqs_fun in global_functions:
+        region = 'us-east-1'
+
+    return collect_resources(account_number, region, sqs_fun, cross_account_role)
+
+
+# Deterministic Id, composite sort key so each slice can be queried directly
+# and the content hash change detection runs on
+def prepare_records(sqs_fun, records):
+
+    natural_key = natural_keys.get(sqs_fun)
+    for r in records:
+        r['Id'] = item_id(sqs_fun, r['AccountNumber'], r['Region'], r[natural_key])
+        r['AccountRegion'] = account_region_key(r['AccountNumber'], r['Region'])
+        r['ContentHash'] = record_fingerprint(r)
+
+    return records
+
+
+# Logic to compare what current boto see's vs whats in dynamodb for one slice
+def sync_slice(account_number, region, sqs_fun, current_boto_list):
+
+    with timed('Diff'):
+        prepare_records(sqs_fun, current_boto_list)
+
+        # Same digest as the last full sync, skip the dynamo read and diff. Every
+        # ENV_DIGEST_MAX_AGE seconds the slice is diffed anyway to catch drift.
+        digest = slice_digest(current_boto_list)
+
+    with timed('DynamoRead'):
+        previous = get_slice_record(sqs_fun, account_number, region)
+
+    if previous is not None and previous.get('Digest') == digest and \
+            time.time() - int(previous.get('VerifiedAt', 0)) < digest_max_age:
+        logger.info('%s in account %s, region %s unchanged, skipping sync', sqs_fun, account_number, region)
+        with timed('Write'):
+            update_slice_record(sqs_fun, account_number, region, len(current_boto_list))
+        emit_metrics({'SliceSkipped': 1}, {'Function': sqs_fun})
+        return Changeset(added=[], changed=[], removed=[], unchanged=current_boto_list)
+
+    # Get current data sitting in Dynamo and remove inactive entries
+    with timed('DynamoRead'):
+        if sqs_fun == 'org':
+            dynamo_list = get_current_table_without_account(
+                entry_type=sqs_fun, region='us-east-1')
+        else:
+            dynamo_list = get_current_table(
+                account_number=account_number, entry_type=sqs_fun, region=region)
+
+    # Don't treat a failed read as an empty table, that would duplicate everything
+    if dynamo_list is None:
+        raise Exception(f'failed to read current {sqs_fun} items from dynamodb')
+
+    # add new records and remove ones that are no longer current
+    changeset = compare_lists_and_update(
+        boto_list=current_boto_list, dynamo_list=dynamo_list)
+
+    # A new digest means the last sync may have written items and died before
+    # its bump or rollup, so both are redone even when this diff comes back empty
+    stale = changeset.added or changeset.changed or changeset.removed or \
+        previous is None or previous.get('Digest') != digest
+
+    with timed('Write'):
+        if stale:
+            # let list_table know its cached responses for this type are stale
+            bump_entry_type_version(sqs_fun)
+
+            # Rebuilt from the collected records in one put, also after an event
+            # handled by event_handler dropped the digest
+            write_rollup(sqs_fun, account_number, region, current_boto_list)
+
+        # Only remembered once every write went through
+        update_slice_record(sqs_fun, account_number, region, len(current_boto_list), digest)
+    emit_metrics({'SliceSkipped': 0}, {'Function': sqs_fun})
+
+    return changeset
+
+
+# Collect and sync a single function
+def collect_and_sync(account_number, region, sqs_fun, cross_account_role):
+
+    with timed_slice(account_number, region, sqs_fun):
+        with timed('Paginate'):
+            current_boto_list = collect_function(
+                account_number, region, sqs_fun, cross_account_role)
+
+        return sync_slice(account_number, region, sqs_fun, current_boto_list)
+
+
+# Run every ec2 describe call for one account and region concurrently on the
+# same pooled ec2 client, each result is synced as its own slice
+def sync_ec2_family(account_number, region, cross_account_role):
+
+    # Build the shared client (and do the STS call) once up front
+    with timed_slice(account_number, region, 'ec2-family'):
+        create_boto_client(account_number, region, 'ec2', cross_account_role)
+
+    changesets = {}
+    errors = {}
+
+    with ThreadPoolExecutor(max_workers=len(ec2_family_functions)) as executor:
+        futures = [(executor.submit(collect_and_sync, account_number, region, f, cross_account_role), f)
+                   for f in ec2_family_functions]
+
+        for future, sqs_fun in futures:
+            try:
+                changesets[sqs_fun] = future.result()
+            except Exception as e:
+                logger.error('Error: with %s, in account %s, in region %s - %s', sqs_fun, account_number, region, e)
+                errors[sqs_fun] = e
+
+    if errors:
+        raise Exception(f'ec2-family failed for {sorted(errors)}: {errors}')
+
+    return changesets
+
+
 # Logic to compare what current boto see's vs whats in dynamodb
 def compare_and_update_function(account_number, region, sqs_fun, cross_account_role):
-    print('printing event....')
-
-    # init
-    current_boto_list = []
-    dynamo_list = []
-    pop_dynamo = []
-
-    # Get Current Boto Data
-    if sqs_fun == 'lambda':
-        current_boto_list = get_all_lambda(
-            account_number, region, cross_account_role)
-    if sqs_fun == 'ec2':
-        current_boto_list = get_all_ec2(
-            account_number, region, cross_account_role)
-    if sqs_fun == 'rds':
-        current_boto_list = get_all_rds(
-            account_number, region, cross_account_role)
-    if sqs_fun == 'iam-roles':
-        current_boto_list = get_all_iam_roles(
-            account_number, 'us-east-1', cross_account_role)
-    if sqs_fun == 'iam-users':
-        current_boto_list = get_all_iam_users(
-            account_number, 'us-east-1', cross_account_role)
-    if sqs_fun == 'iam-attached-policys':
-        current_boto_list = get_all_iam_attached_policys(
-            account_number, 'us-east-1', cross_account_role)
-    if sqs_fun == 'odcr':
-        current_boto_list = get_all_odcr(
-            account_number, region, cross_account_role)
-    if sqs_fun == 'lightsail':
-        current_boto_list = get_all_lightsail(
-            account_number, region, cross_account_role)
-    if sqs_fun == 'org':
-        current_boto_list = get_organizations(
-            account_number, region, cross_account_role)
-    if sqs_fun == 'vpc':
-        current_boto_list = get_all_vpc(
-            account_number, region, cross_account_role)
-    if sqs_fun == 'network-interfaces':
-        current_boto_list = get_all_network_interfaces(
-            account_number, region, cross_account_role)
-    if sqs_fun == 'subnet':
-        current_boto_list = get_all_subnets(
-            account_number, region, cross_account_role)
-    if sqs_fun == 'ri':
-        current_boto_list = get_all_ris(
-            account_number, region, cross_account_role)
-    if sqs_fun == 's3-buckets':
-        current_boto_list = get_all_s3_buckets(
-            account_number, 'us-east-1', cross_account_role)
+    # Global services are stored under us-east-1 whatever region was passed
+    if sqs_fun in global_functions:
+        region = 'us-east-1'
 
-    # Get current data sitting in Dynamo and remove inactive entries
-    if sqs_fun == 'org':
-        dynamo_list = get_current_table_without_account(
-            entry_type=sqs_fun, region='us-east-1')
-    else:
-        dynamo_list = get_current_table(
-            account_number=account_number, entry_type=sqs_fun, region=region)
+    if sqs_fun == 'ec2-family':
+        return sync_ec2_family(account_number, region, cross_account_role)
 
-    # Deep copy instead of double dynamo read
-    pop_dynamo = copy.deepcopy(dynamo_list)
+    return collect_and_sync(account_number, region, sqs_fun, cross_account_role)
 
-    # remove Id key from dynamodb item and check if value has changed.
-    compare_lists_and_update(
-        boto_list=current_boto_list, dynamo_list=dynamo_list, pop_list=pop_dynamo)
 
+# Send the regions a multi region message didn't get to back to the queue
+def requeue_regions(account_number, function, regions):
 
-# Default Lambda
-def lambda_handler(event, context):
+    region = ','.join(regions)
+    get_client_sqs().send_message(
+        QueueUrl=queue_url,
+        DelaySeconds=0,
+        MessageAttributes={
+            'AccountNumber': {'DataType': 'String', 'StringValue': f'{account_number}'},
+            'Function': {'DataType': 'String', 'StringValue': f'{function}'},
+            'Region': {'DataType': 'String', 'StringValue': f'{region}'}
+        },
+        MessageBody=f'account: {account_number} with function: {function} in region: {region}'
+    )
 
-    print(json.dumps(event))
 
-    # message hasn't failed yet
-    failed_message = False
+# Run one function across several regions on a bounded thread pool sharing one
+# set of credentials. Regions fail independently, and once the lambda is close
+# to its deadline no new region is started. If every region that ran synced,
+# the rest are sent back to the queue. If one failed the record fails as a
+# whole and the sqs retry covers the regions that didn't start, requeueing
+# them as well would sync them twice.
+def run_regions(account_number, regions, function, context):
 
-    try:
-        message = event['Records'][0]
-    except KeyError:
-        print('No messages on the queue!')
+    # Global services only live in us-east-1
+    if function in global_functions:
+        regions = ['us-east-1']
 
-    try:
-        message = event['Records'][0]
-        print(json.dumps(message))
-        function = message['messageAttributes']['Function']['stringValue']
-        account_number = message['messageAttributes']['AccountNumber']['stringValue']
-        region = message['messageAttributes']['Region']['stringValue']
-        receipt_handle = event['Records'][0]['receiptHandle']
+    if not regions:
+        raise ValueError(f'no regions to run {function} in for account {account_number}, is ENV_REGIONS set?')
 
-        print(f'function passed is: {function}')
+    # Do the STS call once for every region
+    if account_number != source_account:
+        assume_sts_credentials(account_number, cross_account_role)
 
-        # Try run each function
-        try:
+    def run_region(region):
+        if context is not None and context.get_remaining_time_in_millis() < region_deadline_ms:
+            return False
+        compare_and_update_function(
+            account_number, region, function, cross_account_role)
+        return True
 
-            # Lambda logic
-            compare_and_update_function(
-                account_number, region, function, cross_account_role)
+    not_started = []
+    errors = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(region_workers, len(regions)))) as executor:
+        futures = [(executor.submit(run_region, region), region) for region in regions]
+
+        for future, region in futures:
+            try:
+                if not future.result():
+                    not_started.append(region)
+            except Exception as e:
+                logger.error('Error: with %s, in account %s, in region %s - %s', function, account_number, region, e)
+                errors[region] = e
+
+    if errors:
+        raise Exception(f'{function} failed in regions {sorted(errors)}, not started {not_started}: {errors}')
+
+    if not_started:
+        logger.warning('close to the deadline, requeueing %s for %s', function, not_started)
+        requeue_regions(account_number, function, not_started)
+
+
+# Process a single sqs record, Region can be one region, a comma separated
+# list or 'all' for every region in ENV_REGIONS
+def process_record(message, context=None):
 
+    function = message['messageAttributes']['Function']['stringValue']
+    account_number = message['messageAttributes']['AccountNumber']['stringValue']
+    region = message['messageAttributes']['Region']['stringValue']
 
-        except ClientError as e:
-            print(
-                f'Error: with {function}, in account {account_number}, in region {region} - {e}')
-            failed_message = True
-            raise e
-        except Exception as e:
-            print(
-                f'Error: with {function}, in account {account_number}, in region {region} - {e}')
-            failed_message = True
-            raise e
+    logger.info('function passed is: %s', function)
 
+    # Try run each function
+    try:
+
+        if region == 'all' or ',' in region:
+            regions = watched_regions if region == 'all' else [r for r in region.split(',') if r]
+            run_regions(account_number, regions, function, context)
+
+        else:
+            # Lambda logic
+            compare_and_update_function(
+                account_number, region, function, cross_account_role)
 
     except ClientError as e:
-        print(f'Error: on processing message, {e}')
-        failed_message = True
+        logger.error('Error: with %s, in account %s, in region %s - %s', function, account_number, region, e)
         raise e
     except Exception as e:
-        print(f'Error: on processing message, {e}')
-        failed_message = True
+        logger.error('Error: with %s, in account %s, in region %s - %s', function, account_number, region, e)
         raise e
 
 
-    # message must have passed, deleting
-    if failed_message is False:
-        client_sqs.delete_message(
-            QueueUrl=queue_url,
-            ReceiptHandle=receipt_handle,
+# Default Lambda, processes every record in the batch and reports the failed
+# ones so sqs only retries those (ReportBatchItemFailures)
+def lambda_handler(event, context):
+
+    sample_log_level()
+    logger.debug('event: %s', event)
+
+    # One off migration for the EntryType-AccountRegion-index
+    if event.get('migrate') == 'account-region':
+        return backfill_account_region(event.get('start_key'), context)
+
+    records = event.get('Records', [])
+    failures = []
+
+    if not records:
+        logger.info('No messages on the queue!')
+        return {'batchItemFailures': failures}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(record_concurrency, len(records)))) as executor:
+        futures = [(executor.submit(process_record, r, context), r) for r in records]
+
+        for future, message in futures:
+            try:
+                future.result()
+            except Exception as e:
+                logger.error('Error: on processing message %s, %s', message.get('messageId'), e)
+                failures.append({'itemIdentifier': message['messageId']})
+
+    logger.info('processed %d messages with %d failures', len(records), len(failures))
+    return {'batchItemFailures': failures}
+
+
+# CloudTrail management events applied one resource at a time by event_handler,
+# event name to the function whose items it changes
+event_functions = {
+    'RunInstances': 'ec2',
+    'StartInstances': 'ec2',
+    'StopInstances': 'ec2',
+    'TerminateInstances': 'ec2',
+    'CreateFunction': 'lambda',
+    'DeleteFunction': 'lambda',
+    'UpdateFunctionConfiguration': 'lambda',
+    'UpdateFunctionCode': 'lambda',
+    'CreateRole': 'iam-roles',
+    'DeleteRole': 'iam-roles',
+    'CreateUser': 'iam-users',
+    'DeleteUser': 'iam-users',
+    'CreateVpc': 'vpc',
+    'DeleteVpc': 'vpc',
+    'CreateSubnet': 'subnet',
+    'DeleteSubnet': 'subnet'
+}
+
+
+# Error codes a single resource describe answers with once the resource is gone
+not_found_codes = ['InvalidInstanceID.NotFound', 'InvalidVpcID.NotFound',
+                   'InvalidSubnetID.NotFound', 'ResourceNotFoundException', 'NoSuchEntity']
+
+
+# Lambda and some IAM event names carry an api version, e.g CreateFunction20150331
+def strip_event_version(event_name):
+    return re.sub(r'\d{8}(v\d+)?$', '', event_name)
+
+
+# Ids of the resources an event touched
+def event_resource_ids(event_name, detail):
+
+    request = detail.get('requestParameters') or {}
+    response = detail.get('responseElements') or {}
+
+    if event_name == 'RunInstances':
+        return [i['instanceId'] for i in response.get('instancesSet', {}).get('items', [])]
+    if event_name in ['StartInstances', 'StopInstances', 'TerminateInstances']:
+        return [i['instanceId'] for i in request.get('instancesSet', {}).get('items', [])]
+    if event_name == 'CreateFunction':
+        return [response.get('functionName', request.get('functionName'))]
+    if event_name in ['DeleteFunction', 'UpdateFunctionConfiguration', 'UpdateFunctionCode']:
+        return [request['functionName']]
+    if event_name in ['CreateRole', 'DeleteRole']:
+        return [request['roleName']]
+    if event_name in ['CreateUser', 'DeleteUser']:
+        return [request['userName']]
+    if event_name == 'CreateVpc':
+        return [response['vpc']['vpcId']]
+    if event_name == 'DeleteVpc':
+        return [request['vpcId']]
+    if event_name == 'CreateSubnet':
+        return [response['subnet']['subnetId']]
+    if event_name == 'DeleteSubnet':
+        return [request['subnetId']]
+
+    return []
+
+
+# Natural key of a resource from the id found in the event, lambda is keyed on
+# its arn but events mostly only have the name
+def event_natural_key(sqs_fun, account_number, region, resource_id):
+
+    if sqs_fun == 'lambda' and not resource_id.startswith('arn:'):
+        partition = 'aws-cn' if region.startswith('cn-') else \
+            'aws-us-gov' if region.startswith('us-gov-') else 'aws'
+        return f'arn:{partition}:lambda:{region}:{account_number}:function:{resource_id}'
+
+    return resource_id
+
+
+# Describe a single resource with the same field mapping the collectors use,
+# returns None if the resource no longer exists
+def describe_resource(account_number, region, sqs_fun, resource_id, cross_account_role):
+
+    client = create_boto_client(account_number, region, collector_specs[sqs_fun]['service'], cross_account_role)
+    extract = extractors[sqs_fun]
+
+    try:
+        if sqs_fun == 'ec2':
+            reservations = client.describe_instances(InstanceIds=[resource_id])['Reservations']
+            for i in reservations:
+                for instance in i['Instances']:
+                    if instance['InstanceId'] == resource_id:
+                        return extract(instance, account_number, region)
+            return None
+        if sqs_fun == 'lambda':
+            return extract(client.get_function_configuration(FunctionName=resource_id), account_number, region)
+        if sqs_fun == 'iam-roles':
+            return extract(client.get_role(RoleName=resource_id)['Role'], account_number, region)
+        if sqs_fun == 'iam-users':
+            return extract(client.get_user(UserName=resource_id)['User'], account_number, region)
+        if sqs_fun == 'vpc':
+            vpcs = client.describe_vpcs(VpcIds=[resource_id])['Vpcs']
+            return extract(vpcs[0], account_number, region) if vpcs else None
+        if sqs_fun == 'subnet':
+            subnets = client.describe_subnets(SubnetIds=[resource_id])['Subnets']
+            return extract(subnets[0], account_number, region) if subnets else None
+    except ClientError as e:
+        if e.response['Error']['Code'] in not_found_codes:
+            return None
+        raise
+
+    raise Exception(f'no single resource describe for {sqs_fun}')
+
+
+# Upsert or delete the one item of a resource named in an event
+def apply_resource_event(account_number, region, sqs_fun, resource_id, cross_account_role):
+
+    record = describe_resource(account_number, region, sqs_fun, resource_id, cross_account_role)
+
+    if record is None:
+        natural_key = event_natural_key(sqs_fun, account_number, region, resource_id)
+        get_table().delete_item(Key={'Id': item_id(sqs_fun, account_number, region, natural_key)})
+        logger.info('Sucessfully deleted %s %s in account %s, region %s', sqs_fun, resource_id, account_number, region)
+        return 'deleted'
+
+    prepare_records(sqs_fun, [record])
+
+    # Strip empty values
+    get_table().put_item(Item={k: v for k, v in record.items() if v})
+    logger.info('Sucessfully added %s %s in account %s, region %s', sqs_fun, resource_id, account_number, region)
+    return 'updated'
+
+
+# The slice no longer matches the digest of its last full sync, drop it so the
+# next sweep diffs the slice instead of skipping it
+def invalidate_slice_digest(sqs_fun, account_number, region):
+
+    try:
+        get_table().update_item(
+            Key={'Id': slice_record_id(sqs_fun, account_number, region)},
+            UpdateExpression='REMOVE Digest, VerifiedAt',
+            ConditionExpression='attribute_exists(Id)'
         )
+    except ClientError as e:
+        # never synced, nothing to invalidate
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+
+# EventBridge 'AWS API Call via CloudTrail' events, keeps single items fresh
+# between full sweeps, see the samples in Back-End/events
+def event_handler(event, context):
+
+    sample_log_level()
+    logger.debug('event: %s', event)
+
+    detail = event.get('detail', {})
+    event_name = strip_event_version(detail.get('eventName', ''))
+    sqs_fun = event_functions.get(event_name)
+
+    if sqs_fun is None:
+        logger.error('Error: no mapping for event %s, ignoring', event_name)
+        return {'event': event_name, 'skipped': 'unmapped'}
+
+    # Failed api calls didn't change anything
+    if detail.get('errorCode'):
+        logger.info('%s failed with %s, ignoring', event_name, detail['errorCode'])
+        return {'event': event_name, 'skipped': 'failed-call'}
+
+    account_number = str(detail.get('recipientAccountId', event.get('account')))
+    region = detail.get('awsRegion', event.get('region'))
+
+    # Global services are stored under us-east-1 whatever region was passed
+    if sqs_fun in global_functions:
+        region = 'us-east-1'
+
+    resource_ids = event_resource_ids(event_name, detail)
+
+    # Dropped before the items change, if the bump below never happens the next
+    # sweep diffs the slice and bumps the version itself
+    if resource_ids:
+        invalidate_slice_digest(sqs_fun, account_number, region)
+
+    result = {'event': event_name, 'function': sqs_fun, 'updated': 0, 'deleted': 0}
+    for resource_id in resource_ids:
+        result[apply_resource_event(
+            account_number, region, sqs_fun, resource_id, cross_account_role)] += 1
+
+    if result['updated'] or result['deleted']:
+        bump_entry_type_version(sqs_fun)
+
+    logger.info('applied event: %s', result)
+    return result
@@ -4,8 +4,14 @@
 import boto3
 import json
 import os
+import time
+import random
 import decimal
-from botocore.exceptions import ClientError
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import BotoCoreError, ClientError
 
 
 # Helper class for Dynamo
@@ -28,12 +34,83 @@ try:
 except Exception as e:
     print(f'No os.environment in lambda.... {e}')
 
+# Pruning needs the table name, without it every slice is sent
+table_name_multi = os.environ.get('ENV_TABLE_NAME_MULTI')
 
-# Try connect sqs
-try:
-    sqs = boto3.client('sqs', region_name=source_region)
-except Exception as e:
-    print(f'cant connect to sqs.... {e}')
+# SQS holds a message back for at most 15 minutes
+max_delay_seconds = 900
+
+
+# Optional tuning value, a missing or bad one falls back to its own default
+# and leaves the others alone
+def env_setting(name, default, parse=int, valid=None):
+
+    value = os.environ.get(name, '')
+    if not value:
+        return default
+
+    try:
+        parsed = parse(value)
+        if valid is not None and not valid(parsed):
+            raise ValueError('out of range')
+        return parsed
+    except Exception as e:
+        print(f'Error: bad {name} {value!r}, using {default}.... {e}')
+        return default
+
+
+# Optional tuning for the fan-out
+send_workers = env_setting('ENV_SEND_WORKERS', 8, int, lambda v: v >= 1)
+empty_rescan_seconds = env_setting('ENV_EMPTY_RESCAN_MINUTES', 60) * 60
+fanout_window_seconds = min(max_delay_seconds, env_setting('ENV_FANOUT_WINDOW_SECONDS', 240, int, lambda v: v >= 0))
+fanout_jitter_seconds = env_setting('ENV_FANOUT_JITTER_SECONDS', 5.0, float, lambda v: v >= 0)
+account_messages_per_second = env_setting('ENV_ACCOUNT_MESSAGES_PER_SECOND', 2.0, float, lambda v: v > 0)
+fanout_shard_accounts = env_setting('ENV_FANOUT_SHARD_ACCOUNTS', 50, int, lambda v: v >= 1)
+fanout_reserve_ms = env_setting('ENV_FANOUT_RESERVE_MS', 10000, int, lambda v: v >= 0)
+
+
+# Clients are built on first use and kept for warm invocations, a call that
+# never prunes never loads the dynamodb resource model
+sqs = None
+table = None
+client_lambda = None
+client_lock = threading.Lock()
+
+
+# SQS client, shared by the send workers
+def get_sqs():
+
+    global sqs
+    if sqs is None:
+        with client_lock:
+            if sqs is None:
+                sqs = boto3.client('sqs', region_name=source_region,
+                                   config=Config(max_pool_connections=max(10, send_workers)))
+
+    return sqs
+
+
+# Dynamo table, only used to prune empty slices, None without a table name
+def get_table():
+
+    global table
+    if table is None and table_name_multi:
+        try:
+            table = boto3.resource('dynamodb', region_name=source_region).Table(table_name_multi)
+        except Exception as e:
+            print(f'failed to speak to dynamo, not pruning.... {e}')
+
+    return table
+
+
+# Lambda client, only used to hand the remaining shards to a new invocation
+def get_client_lambda():
+
+    global client_lambda
+    if client_lambda is None:
+        client_lambda = boto3.client('lambda', region_name=source_region)
+
+    return client_lambda
 
 
 def reply(message, status_code):
@@ -50,13 +127,11 @@ def reply(message, status_code):
     }
 
 
-# Send message to SQS queue
-def send_sqs_message(accountNumber, function, region):
+# Message attributes and body the receiver expects
+def message_fields(accountNumber, function, region):
 
-    response = sqs.send_message(
-        QueueUrl=queue_url,
-        DelaySeconds=0,
-        MessageAttributes={
+    return {
+        'MessageAttributes': {
             'AccountNumber': {
                 'DataType': 'String',
                 'StringValue': f'{accountNumber}'
@@ -70,21 +145,318 @@ def send_sqs_message(accountNumber, function, region):
                 'StringValue': f'{region}'
             }
         },
-        MessageBody=(
+        'MessageBody': (
             f'account: {accountNumber} with function: {function} in region: {region}'
         )
+    }
+
+
+# Send message to SQS queue
+def send_sqs_message(accountNumber, function, region, delaySeconds=0):
+
+    response = get_sqs().send_message(
+        QueueUrl=queue_url,
+        DelaySeconds=delaySeconds,
+        **message_fields(accountNumber, function, region)
     )
 
     return response
 
 
+# Send up to 10 messages in one call, retrying failed entries one by one. Api
+# and connection errors only fail the messages they hit, never the fan-out.
+def send_sqs_batch(messages):
+
+    entries = []
+    for n, m in enumerate(messages):
+        entry = {'Id': str(n), 'DelaySeconds': m.get('delaySeconds', 0)}
+        entry.update(message_fields(m['accountNumber'], m['function'], m['region']))
+        entries.append(entry)
+
+    try:
+        response = get_sqs().send_message_batch(QueueUrl=queue_url, Entries=entries)
+        failed_ids = [f['Id'] for f in response.get('Failed', [])]
+    except (ClientError, BotoCoreError) as e:
+        print(f'batch send failed, retrying each message: {e}')
+        failed_ids = [entry['Id'] for entry in entries]
+
+    failed = 0
+    for i in failed_ids:
+        try:
+            send_sqs_message(**messages[int(i)])
+        except (ClientError, BotoCoreError) as e:
+            print(f'Error: failed to send {messages[int(i)]} - {e}')
+            failed += 1
+
+    return len(messages) - failed, failed
+
+
+# Send every message in batches of 10 from a bounded pool of workers
+def send_sqs_messages(messages):
+
+    start = time.time()
+    batches = [messages[i:i + 10] for i in range(0, len(messages), 10)]
+
+    with ThreadPoolExecutor(max_workers=send_workers) as executor:
+        results = list(executor.map(send_sqs_batch, batches))
+
+    return {
+        'enqueued': sum(r[0] for r in results),
+        'failed': sum(r[1] for r in results),
+        'seconds': round(time.time() - start, 3)
+    }
+
+
+# Functions the ec2-family message covers, the receiver keeps their activity
+# under these names
+ec2_family_functions = ['vpc', 'subnet', 'network-interfaces', 'ec2', 'odcr', 'ri']
+
+
+# Activity the receiver records for every (account, region, function) slice
+def get_slice_activity():
+
+    activity = {}
+    kwargs = {
+        'IndexName': 'EntryType-index',
+        'KeyConditionExpression': Key('EntryType').eq('slice-activity'),
+        'ProjectionExpression': 'AccountNumber, #r, #f, ResultCount, CollectedAt',
+        'ExpressionAttributeNames': {'#r': 'Region', '#f': 'Function'}
+    }
+
+    while True:
+        response = get_table().query(**kwargs)
+        for i in response['Items']:
+            activity[(i['AccountNumber'], i['Region'], i['Function'])] = i
+        if 'LastEvaluatedKey' not in response:
+            return activity
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+# Is a message worth sending, slices that were empty last time are only
+# rescanned every ENV_EMPTY_RESCAN_MINUTES. Unknown slices are always sent.
+def is_active(message, activity, now):
+
+    if message['function'] == 'ec2-family':
+        functions = ec2_family_functions
+    else:
+        functions = [message['function']]
+
+    collected = []
+    for f in functions:
+        slice_activity = activity.get((message['accountNumber'], message['region'], f))
+        if slice_activity is None or int(slice_activity.get('ResultCount', 0)) > 0:
+            return True
+        collected.append(int(slice_activity.get('CollectedAt', 0)))
+
+    return now - min(collected) >= empty_rescan_seconds
+
+
+# Slice activity to prune with, None without a table or if it can't be read
+def read_slice_activity():
+
+    if get_table() is None:
+        return None
+
+    try:
+        return get_slice_activity()
+    except ClientError as e:
+        print(f'failed to read slice activity, not pruning: {e}')
+        return None
+
+
+# Drop messages for slices that have been empty recently
+def prune_empty_slices(messages, activity):
+
+    if activity is None:
+        return messages
+
+    now = time.time()
+    return [m for m in messages if is_active(m, activity, now)]
+
+
+# Set DelaySeconds on every message so the fan-out trickles in instead of
+# landing at once. Accounts start evenly spaced over the window (by their
+# position among all accounts, so every shard follows one plan), each message
+# gets up to jitter seconds on top and an account never gets more than
+# ENV_ACCOUNT_MESSAGES_PER_SECOND. elapsed is how long ago the fan-out
+# started, later shards send that much closer to their slot.
+def schedule_messages(messages, positions, account_count, window, jitter, elapsed=0.0):
+
+    spacing = window / max(1, account_count)
+    gap = 1.0 / account_messages_per_second
+    next_free = {}
+    clipped = 0
+
+    for m in messages:
+        account = m['accountNumber']
+        start = positions.get(account, 0) * spacing
+        at = max(start + random.uniform(0, jitter), next_free.get(account, 0.0))
+        next_free[account] = at + gap
+
+        delay = int(at - elapsed)
+        if delay > max_delay_seconds:
+            clipped += 1
+        m['delaySeconds'] = min(max_delay_seconds, max(0, delay))
+
+    if clipped:
+        print(f'{clipped} messages needed more than {max_delay_seconds}s of delay, '
+              f'raise ENV_ACCOUNT_MESSAGES_PER_SECOND or shorten ENV_FANOUT_WINDOW_SECONDS')
+
+    return messages
+
+
+# Accounts in shards of ENV_FANOUT_SHARD_ACCOUNTS
+def account_shards(list_of_accounts):
+    return [list_of_accounts[i:i + fanout_shard_accounts]
+            for i in range(0, len(list_of_accounts), fanout_shard_accounts)]
+
+
+# Hand the shards this invocation has no time left for to a new one
+def continue_fanout(context, passed_function, full_refresh, shard, started_at):
+
+    get_client_lambda().invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps({'fanout': {
+            'function': passed_function,
+            'full': full_refresh,
+            'shard': shard,
+            'startedAt': started_at
+        }})
+    )
+
+
+# Send the fan-out one shard of accounts at a time, starting at shard. Keeps
+# going while there's ENV_FANOUT_RESERVE_MS left, then re-invokes itself for
+# the rest.
+def run_fanout(passed_function, list_of_accounts, list_of_regions, full_refresh, shard, started_at, context):
+
+    shards = account_shards(list_of_accounts)
+    positions = {a: n for n, a in enumerate(list_of_accounts)}
+    result = {'enqueued': 0, 'failed': 0, 'pruned': 0, 'shards': 0, 'spread_seconds': 0}
+
+    # Cron skips slices that keep coming back empty, unless it's a full refresh
+    prune = passed_function == 'cron' and not full_refresh
+    activity = read_slice_activity() if prune else None
+
+    # Only cron is spread out, a refresh from the UI should show up right away
+    if passed_function == 'cron':
+        window, jitter = fanout_window_seconds, fanout_jitter_seconds
+    else:
+        window, jitter = 0, 0
+
+    start = time.time()
+    while shard < len(shards):
+
+        messages = build_fanout(
+            passed_function, shards[shard], list_of_regions, include_org=shard == 0)
+
+        if prune:
+            active = prune_empty_slices(messages, activity)
+            result['pruned'] += len(messages) - len(active)
+            messages = active
+
+        schedule_messages(messages, positions, len(list_of_accounts), window, jitter, time.time() - started_at)
+        print(f'sending {len(messages)} messages for function: {passed_function}, shard {shard + 1} of {len(shards)}')
+
+        sent = send_sqs_messages(messages)
+        result['enqueued'] += sent['enqueued']
+        result['failed'] += sent['failed']
+        result['shards'] += 1
+        result['spread_seconds'] = max([result['spread_seconds']] + [m['delaySeconds'] for m in messages])
+        shard += 1
+
+        if shard < len(shards) and context is not None and \
+                context.get_remaining_time_in_millis() < fanout_reserve_ms:
+            try:
+                continue_fanout(context, passed_function, full_refresh, shard, started_at)
+                result['continued_at_shard'] = shard
+            except (ClientError, BotoCoreError) as e:
+                print(f'Error: failed to continue the fan-out at shard {shard} - {e}')
+                result['unsent_shards'] = len(shards) - shard
+            break
+
+    result['seconds'] = round(time.time() - start, 3)
+    return result
+
+
+# Build the list of messages for the passed function, the org message only
+# goes out with the first shard
+def build_fanout(passed_function, list_of_accounts, list_of_regions, include_org=True):
+
+    messages = []
+
+    # Global API that don't need to hit every region, e.g IAM, S3 etc
+    global_api = ['iam-roles', 'iam-users',
+                  'iam-attached-policys', 's3-buckets']
+
+    # Functions that run in every region, ec2-family covers vpc, subnet,
+    # network-interfaces, ec2, odcr and ri in one message
+    regional_api = ['lambda', 'rds', 'lightsail', 'ec2-family']
+
+    # if cron, send all messages to all accounts
+    if passed_function == 'cron':
+
+        # Organizations only needs source_account
+        if include_org:
+            messages.append({'accountNumber': source_account,
+                             'function': 'org', 'region': 'us-east-1'})
+
+        for i in list_of_accounts:
+
+            # Global API, don't hit each region
+            for f in global_api:
+                messages.append(
+                    {'accountNumber': i, 'function': f, 'region': 'us-east-1'})
+
+            for b in list_of_regions:
+                for f in regional_api:
+                    messages.append(
+                        {'accountNumber': i, 'function': f, 'region': b})
+
+    # if function is organizations
+    elif passed_function == 'org':
+        if include_org:
+            messages.append({'accountNumber': source_account,
+                             'function': 'org', 'region': 'us-east-1'})
+
+    # if function is global and doesn't need each region
+    elif passed_function in global_api:
+        for i in list_of_accounts:
+            messages.append(
+                {'accountNumber': i, 'function': passed_function, 'region': 'us-east-1'})
+
+    # Else send the function to all accounts, one message per account that
+    # the receiver runs across every region
+    else:
+
+        for i in list_of_accounts:
+            messages.append(
+                {'accountNumber': i, 'function': passed_function, 'region': ','.join(list_of_regions)})
+
+    return messages
+
+
 # Lambda Handler
 def lambda_handler(event, context):
 
     try:
 
         print(json.dumps(event))
-        passed_function = event['queryStringParameters']['function']
+
+        # The rest of a fan-out an earlier invocation ran out of time for
+        continuation = event.get('fanout')
+        if continuation:
+            passed_function = continuation['function']
+            full_refresh = continuation['full']
+            shard = int(continuation['shard'])
+            started_at = float(continuation['startedAt'])
+        else:
+            passed_function = event['queryStringParameters']['function']
+            full_refresh = str(event['queryStringParameters'].get('full', '')).lower() in ('true', '1')
+            shard = 0
+            started_at = time.time()
+
         print(f'function is {passed_function}')
 
         # Get Accounts
@@ -97,74 +469,14 @@ def lambda_handler(event, context):
         for b in regions.split(','):
             list_of_regions.append(b)
 
-        # Global API that don't need to hit every region, e.g IAM, S3 etc
-        global_api = ['iam-roles', 'iam-users',
-                      'iam-attached-policys', 's3-buckets']
-
-        # if cron, send all messages to all accounts
-        if passed_function == 'cron':
-
-            # Organizations only needs source_account
-            send_sqs_message(accountNumber=source_account,
-                             function='org', region='us-east-1')
-
-            for i in list_of_accounts:
-
-                # Global API, don't hit each region
-                send_sqs_message(
-                    accountNumber=i, function='iam-roles', region='us-east-1')
-                send_sqs_message(
-                    accountNumber=i, function='iam-users', region='us-east-1')
-                send_sqs_message(
-                    accountNumber=i, function='iam-attached-policys', region='us-east-1')
-                send_sqs_message(
-                    accountNumber=i, function='s3-buckets', region='us-east-1')
-
-                for b in list_of_regions:
-
-                    print(
-                        f'cron passed: {passed_function} in account: {i} into region: {b}')
-                    send_sqs_message(
-                        accountNumber=i, function='lambda', region=b)
-                    send_sqs_message(accountNumber=i, function='ec2', region=b)
-                    send_sqs_message(accountNumber=i, function='rds', region=b)
-                    send_sqs_message(
-                        accountNumber=i, function='odcr', region=b)
-                    send_sqs_message(
-                        accountNumber=i, function='lightsail', region=b)
-                    send_sqs_message(accountNumber=i, function='vpc', region=b)
-                    send_sqs_message(
-                        accountNumber=i, function='network-interfaces', region=b)
-                    send_sqs_message(
-                        accountNumber=i, function='subnet', region=b)
-                    send_sqs_message(accountNumber=i, function='ri', region=b)
-
-        # if function is organizations
-        elif passed_function == 'org':
-            send_sqs_message(accountNumber=source_account,
-                             function='org', region='us-east-1')
-
-        # if function is global and doesn't need each region
-        elif passed_function in global_api:
-            for i in list_of_accounts:
-                send_sqs_message(
-                    accountNumber=i, function=passed_function, region='us-east-1')
-
-        # Else send the function to all accounts
-        else:
-
-            for i in list_of_accounts:
-
-                # Do rest of calls in list of regions
-                for b in list_of_regions:
-                    print(
-                        f'sending function: {passed_function} in account: {i} into region: {b}')
-                    send_sqs_message(
-                        accountNumber=i, function=passed_function, region=b)
+        result = run_fanout(passed_function, list_of_accounts, list_of_regions,
+                            full_refresh, shard, started_at, context)
+        print(f'fan-out result: {result}')
 
         # Reply back
-        return reply(message='sucessfully passed message to sqs', status_code=200)
+        result['message'] = 'sucessfully passed message to sqs'
+        return reply(message=result, status_code=200)
 
-    except ClientError as e:
+    except (ClientError, BotoCoreError) as e:
         print('Unexpected error: %s' % e)
         return reply(message={'message': f'Error: {e}'}, status_code=500)